@@ -0,0 +1,216 @@
+#!/usr/bin/python
+
+"""
+    Finds and carves Xbox 360 files (PNG, XDBF, STFS and XTAF) out of images of any size.
+    The image is mapped (or read in large overlapping chunks) and searched for every signature at once
+    with one compiled regular expression, chunks are searched in parallel by a pool of processes.
+    To use this try something like:
+    from carve import Carver, unallocated_ranges
+    c = Carver('/mnt/data/201010.bin')
+    hits = c.scan(unallocated_ranges(Partition('/mnt/data/201010.bin')))
+    c.carve('/tmp/carved/x', hits)
+"""
+
+import re
+import sys
+import mmap
+import struct
+import multiprocessing
+from cStringIO import StringIO
+from stfs import STFS
+from xboxmagic import PNG_HEADER, PNG_FOOTER, XDBF_HEADER, XTAF_HEADER, STFS_HEADERS
+
+SIGNATURES = {'PNG': (PNG_HEADER,), 'XDBF': (XDBF_HEADER,), 'STFS': STFS_HEADERS, 'XTAF': (XTAF_HEADER,)}
+EXTENSIONS = {'PNG': 'png', 'XDBF': 'gpd', 'STFS': 'stfs', 'XTAF': 'xtaf'}
+MAX_SIZE = {'PNG': 0x1000000, 'XDBF': 0x4000000} # How far to look for the end of a file
+WINDOW = 0x100000 # How much of the image carve reads at a time
+
+def signature_pattern(kinds):
+    """ Compiles one expression matching the signatures of every kind, the group name is the kind """
+    return re.compile("|".join("(?P<%s>%s)" % (kind, "|".join(re.escape(s) for s in SIGNATURES[kind]))\
+                               for kind in kinds))
+
+def scan_chunk(job):
+    """ Returns (offset, kind) for every signature that starts between start and end in filename.
+        Runs in the worker processes, the search runs overlap bytes past end so signatures on the boundary are found.
+    """
+    filename, kinds, start, end, overlap = job
+    pattern = signature_pattern(kinds)
+    fd = open(filename, 'rb')
+    try:
+        try:
+            data = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+            base = 0
+        except (mmap.error, ValueError, OverflowError): # Block devices, files too big to map
+            fd.seek(start)
+            data = fd.read(end - start + overlap)
+            base = start
+        hits = [(match.start() + base, match.lastgroup) for match in\
+                pattern.finditer(data, start - base, min(end + overlap, base + len(data)) - base)\
+                if match.start() + base < end]
+        if base == 0:
+            data.close()
+        return hits
+    finally:
+        fd.close()
+
+def unallocated_ranges(partition):
+    """ Returns the (start, end) in the image of every run of free clusters in an XTAF partition.
+        Free FAT entries are all zeros so they're found by searching the raw FAT for runs of zero bytes.
+    """
+    fat = partition.fat_data
+    ranges = []
+    for match in re.finditer("\x00{4,}", fat):
+        first = max((match.start() + 3) >> 2, 2) # Entries 0 and 1 (the root directory) are never free
+        last = match.end() >> 2
+        if first < last:
+            start = (first - 1 << 14L) + partition.root_dir
+            end = (last - 1 << 14L) + partition.root_dir
+            if ranges and ranges[-1][1] == start:
+                ranges[-1] = (ranges[-1][0], end)
+            else:
+                ranges.append((start, end))
+    return ranges
+
+class Hit(object):
+    """ A signature found by Carver.scan, offset is from the start of the image """
+    def __str__(self):
+        return "%s at 0x%x" % (self.kind, self.offset)
+
+    def __init__(self, offset, kind):
+        self.offset = offset
+        self.kind = kind
+
+class Carver(object):
+    """ Searches an image for the signatures of kinds (all of SIGNATURES by default) """
+    def __init__(self, filename, kinds=None, workers=None, chunksize=0x4000000):
+        self.filename = filename
+        self.kinds = kinds or sorted(SIGNATURES)
+        self.workers = workers or multiprocessing.cpu_count()
+        self.chunksize = chunksize
+        self.overlap = max(len(s) for kind in self.kinds for s in SIGNATURES[kind]) - 1
+        fd = open(filename, 'rb')
+        fd.seek(0, 2)
+        self.size = fd.tell()
+        fd.close()
+
+    def chunks(self, ranges):
+        """ Splits (start, end) ranges into scan jobs of at most chunksize bytes """
+        for start, end in ranges:
+            end = min(end, self.size)
+            for chunk in xrange(start, end, self.chunksize):
+                yield (self.filename, self.kinds, chunk, min(chunk + self.chunksize, end), self.overlap)
+
+    def scan(self, ranges=None):
+        """ Returns a Hit for every signature in ranges, a list of (start, end) (the whole image by default),
+            ordered by offset
+        """
+        if ranges == None:
+            ranges = [(0, self.size)]
+        jobs = list(self.chunks(ranges))
+        if self.workers == 1 or len(jobs) == 1:
+            results = map(scan_chunk, jobs)
+        else:
+            pool = multiprocessing.Pool(self.workers)
+            try:
+                results = pool.map(scan_chunk, jobs, 1)
+            finally:
+                pool.close()
+                pool.join()
+        return [Hit(offset, kind) for offset, kind in sorted(hit for hits in results for hit in hits)]
+
+    def read(self, fd, offset, length):
+        """ Reads length bytes at offset in the image, less at the end of it """
+        fd.seek(offset)
+        return fd.read(length)
+
+    def measure(self, fd, hit):
+        """ Returns the length of the file at a hit or None if its end can't be found (and for XTAF).
+            Only the headers (or for PNGs up to MAX_SIZE a window at a time) are read.
+        """
+        offset = hit.offset
+        if hit.kind == 'PNG': # Windows overlap so a footer across the edge of one is still found
+            end = min(offset + MAX_SIZE['PNG'], self.size)
+            position = offset
+            while True:
+                data = self.read(fd, position, min(WINDOW, end - position))
+                footer = data.find(PNG_FOOTER)
+                if footer != -1:
+                    return position + footer + len(PNG_FOOTER) - offset
+                if position + len(data) >= end or len(data) < len(PNG_FOOTER):
+                    return None
+                position += len(data) - len(PNG_FOOTER) + 1
+
+        elif hit.kind == 'XDBF': # The end of the last entry's payload or free space
+            header = self.read(fd, offset, 0x18)
+            if len(header) < 0x18: # Too close to the end of the image to be a GPD
+                return None
+            table_len, entry_count, free_len, free_count = struct.unpack(">8xIIII", header)
+            global_offset = table_len * 0x12 + free_len * 0x8 + 0x18
+            if entry_count > table_len or free_count > free_len or global_offset > MAX_SIZE['XDBF']:
+                return None
+            length = global_offset
+            tables = self.read(fd, offset + 0x18, global_offset - 0x18)
+            if len(tables) < global_offset - 0x18:
+                return None
+            entries = tables[:entry_count * 0x12]
+            for e in xrange(0, len(entries) - 0x11, 0x12):
+                payload_offset, payload_length = struct.unpack(">II", entries[e + 10:e + 18])
+                length = max(length, global_offset + payload_offset + payload_length)
+            free = tables[table_len * 0x12:table_len * 0x12 + free_count * 8]
+            for f in xrange(0, len(free) - 7, 8):
+                free_offset, free_length = struct.unpack(">II", free[f:f + 8])
+                if global_offset + free_offset + free_length <= MAX_SIZE['XDBF']:
+                    length = max(length, global_offset + free_offset + free_length)
+            if length > MAX_SIZE['XDBF']:
+                return None
+            return length
+
+        elif hit.kind == 'STFS': # The end of the last allocated block
+            try:
+                s = STFS(None, fd=StringIO(self.read(fd, offset, 0x171A)), lazy=True)
+            except (AssertionError, struct.error):
+                return None
+            if s.allocated_count == 0:
+                return 0xc000
+            return 0xc000 + (s.fix_blocknum(s.allocated_count - 1) + 1) * 0x1000
+        return None
+
+    def carve(self, prefix, hits):
+        """ Writes the file at each hit to prefix.NNNN.ext, hits inside a file already carved are skipped.
+            Files are copied a WINDOW at a time so memory use doesn't grow with the image or the files.
+            Returns the number of files written.
+        """
+        fd = open(self.filename, 'rb')
+        files_found = 0
+        carved_to = 0
+        try:
+            for hit in sorted(hits, key=lambda hit: hit.offset):
+                if hit.offset < carved_to:
+                    continue
+                length = self.measure(fd, hit)
+                if length == None or hit.offset + length > self.size: # Not a real file or cut off
+                    continue
+                with open("%s.%0.4d.%s" % (prefix, files_found, EXTENSIONS[hit.kind]), 'wb') as out:
+                    for position in xrange(hit.offset, hit.offset + length, WINDOW):
+                        out.write(self.read(fd, position, min(WINDOW, hit.offset + length - position)))
+                carved_to = hit.offset + length
+                files_found += 1
+        finally:
+            fd.close()
+        return files_found
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3:
+        print "Usage: carve.py <output_prefix> <image> [-u]"
+        print "Carves PNG, XDBF and STFS files out of an image, -u searches only the unallocated clusters of an XTAF image"
+        sys.exit(1)
+    carver = Carver(sys.argv[2])
+    ranges = None
+    if '-u' in sys.argv[3:]:
+        from partition import Partition
+        ranges = unallocated_ranges(Partition(sys.argv[2]))
+    hits = carver.scan(ranges)
+    for hit in hits:
+        print hit
+    print "Carved %d files" % carver.carve(sys.argv[1], hits)
@@ -0,0 +1,131 @@
+#!/usr/bin/python
+
+"""
+    Builds a catalogue of the STFS containers on an XTAF partition without running a full report.
+    To use this try something like:
+    from catalogue import Catalogue, JSONLSink
+    Catalogue(Partition('/mnt/data/201010.bin', threadsafe=True)).build(JSONLSink(open('drive.jsonl', 'w')))
+"""
+
+import sys
+import time
+import json
+import sqlite3
+import binascii
+from multiprocessing.pool import ThreadPool
+from partition import Partition, XTAFFD
+from constants import ContentTypes
+from stfs import STFS
+from xboxmagic import STFS_HEADERS
+
+FIELDS = ('path', 'title_id', 'content_type', 'profile_id', 'display_name', 'size')
+HEADER_SIZE = 0x171A # The fixed part of an STFS header, see STFS(lazy=True)
+
+class JSONLSink(object):
+    """ Writes each catalogue row as a line of JSON to a file object """
+    def __init__(self, fd):
+        self.fd = fd
+
+    def write(self, row):
+        self.fd.write(json.dumps(row) + "\n")
+
+    def close(self):
+        self.fd.flush()
+
+class SQLiteSink(object):
+    """ Writes catalogue rows to a table in an SQLite database, committing every batch rows """
+    def __init__(self, filename, table='catalogue', batch=1000):
+        self.db = sqlite3.connect(filename)
+        self.table = table
+        self.batch = batch
+        self.pending = 0
+        self.db.execute("CREATE TABLE IF NOT EXISTS %s (path TEXT PRIMARY KEY, title_id INTEGER, content_type TEXT,"\
+                        " profile_id TEXT, display_name TEXT, size INTEGER)" % table)
+        self.insert = "INSERT OR REPLACE INTO %s VALUES (?, ?, ?, ?, ?, ?)" % table
+
+    def write(self, row):
+        self.db.execute(self.insert, [row[field] for field in FIELDS])
+        self.pending += 1
+        if self.pending >= self.batch:
+            self.db.commit()
+            self.pending = 0
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+
+class Catalogue(object):
+    """ Finds the STFS containers below a path on a partition and parses their headers with a pool of workers.
+        Files are classified by the magic at the start of their first cluster and only the fixed part of
+        each header is read. The partition needs to be threadsafe for reads to overlap.
+    """
+    def __init__(self, partition, workers=8):
+        self.partition = partition
+        self.workers = partition.parallel_workers(workers)
+        self.errors = []
+
+    def candidates(self, path = '/'):
+        """ Yields the XTAFEntry of every file below path big enough to hold an STFS header """
+        for entry in self.partition.scan(path):
+            if not entry.isDirectory() and entry.size >= HEADER_SIZE:
+                yield entry
+
+    def parse(self, entry):
+        """ Returns the catalogue row for an entry or None if it isn't an STFS container """
+        try:
+            if self.partition.read_file(fileobj=entry.fileobj, size=4) not in STFS_HEADERS:
+                return None
+            s = STFS(entry.path, fd=XTAFFD(self.partition, entry.fileobj), lazy=True)
+            return {'path': entry.path,
+                    'title_id': s.title_id,
+                    'content_type': ContentTypes.types.get(s.content_type, hex(s.content_type)),
+                    'profile_id': binascii.hexlify(s.profile_id).upper(), # As the profile directories are named
+                    'display_name': s.display_name.decode('utf-16-be', 'replace').split(u'\x00')[0],
+                    'size': entry.size}
+        except Exception as e: # A damaged container shouldn't stop the rest
+            self.errors.append((entry.path, str(e)))
+            return None
+
+    def rows(self, path = '/'):
+        """ A generator that yields a row (a dict of FIELDS) for every STFS container below path """
+        self.partition.crawl(path, self.workers) # Read the directories in parallel first
+        pool = ThreadPool(self.workers)
+        try:
+            for row in pool.imap_unordered(self.parse, self.candidates(path), 16):
+                if row != None:
+                    yield row
+        finally:
+            pool.close()
+            pool.join()
+
+    def build(self, sink, path = '/'):
+        """ Writes a row for every STFS container below path to sink as they are found.
+            Returns (containers, seconds).
+        """
+        begin = time.time()
+        count = 0
+        try:
+            for row in self.rows(path):
+                sink.write(row)
+                count += 1
+        finally:
+            sink.close()
+        return (count, time.time() - begin)
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3:
+        print "Usage: catalogue.py <XTAF image> <output.jsonl or output.db> [workers]"
+        print "Lists the STFS containers on a partition with their title id, content type, profile and name"
+        sys.exit(1)
+    workers = 8
+    if len(sys.argv) > 3:
+        workers = int(sys.argv[3])
+    if sys.argv[2].endswith('.db'):
+        sink = SQLiteSink(sys.argv[2])
+    else:
+        sink = JSONLSink(open(sys.argv[2], 'w'))
+    catalogue = Catalogue(Partition(sys.argv[1], threadsafe=True), workers)
+    count, seconds = catalogue.build(sink)
+    for path, error in catalogue.errors:
+        print "Error reading %s: %s" % (path, error)
+    print "Catalogued %d STFS containers in %.2fs" % (count, seconds)
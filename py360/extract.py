@@ -0,0 +1,180 @@
+#!/usr/bin/python
+
+"""
+    Bulk extraction of everything in an STFS container or an XTAF partition to a directory.
+    To use this try something like:
+    from extract import Extractor
+    print Extractor(Partition('/mnt/data/201010.bin', threadsafe=True), '/tmp/out', workers=8).run()
+"""
+
+import os
+import sys
+import time
+from multiprocessing.pool import ThreadPool
+from partition import Partition
+from stfs import STFS
+from xboxmagic import is_stfs
+
+class ExtractReport(object):
+    """ The result of Extractor.run
+        bytes is the total size of the files written, sparse the part of that left as holes
+        errors is a list of (path, message) for the files that couldn't be extracted
+    """
+    def __str__(self):
+        return "Extracted %d files (%d directories), %.1f MB (%.1f MB sparse), %d errors in %.2fs, %.1f MB/s" %\
+               (self.files, self.dirs, self.bytes / 2.0**20, self.sparse / 2.0**20, len(self.errors),\
+                self.seconds, self.throughput() / 2**20)
+
+    def __init__(self):
+        self.files = 0
+        self.dirs = 0
+        self.bytes = 0
+        self.sparse = 0
+        self.errors = []
+        self.seconds = 0.0
+
+    def throughput(self):
+        """ Bytes extracted per second """
+        if self.seconds > 0:
+            return self.bytes / self.seconds
+        return 0.0
+
+class Extractor(object):
+    """ Writes every file below path in an STFS or Partition object out to outdir with a pool of
+        workers. Each file is streamed in chunks of chunksize, its output is preallocated to the
+        final size and every holesize bytes (a page) that are all zeros are left as holes when sparse is set.
+        A Partition needs to be threadsafe for reads to overlap, otherwise one file is read at a time.
+    """
+    def __init__(self, source, outdir, workers=4, chunksize=0x100000, sparse=True, holesize=0x1000):
+        self.source = source
+        self.outdir = outdir
+        self.workers = workers
+        self.chunksize = chunksize
+        self.sparse = sparse
+        self.holesize = holesize
+        self.partition = isinstance(source, Partition) # Otherwise an STFS object
+        if self.partition:
+            self.workers = source.parallel_workers(workers)
+
+    def entries(self, path = '/'):
+        """ Yields (path, isdirectory, size, object) for everything below path, parents before children """
+        if self.partition:
+            for entry in self.source.scan(path):
+                yield (entry.path, entry.isDirectory(), entry.size, entry.fileobj)
+        else:
+            for fullpath in self.source.walk(path):
+                fl = self.source.allfiles[fullpath]
+                yield (fullpath, fl.isdirectory, fl.size, fl)
+
+    def chunks(self, obj):
+        """ The chunks of a file given its FileListing or FileObj """
+        if self.partition:
+            return self.source.iter_file(fileobj=obj, chunksize=self.chunksize)
+        return self.source.iter_file(filelisting=obj, chunksize=self.chunksize)
+
+    def run(self, path = '/'):
+        """ Extract everything below path, returns an ExtractReport """
+        report = ExtractReport()
+        begin = time.time()
+        if not os.path.isdir(self.outdir):
+            os.makedirs(self.outdir)
+        files = []
+        for fullpath, isdirectory, size, obj in self.entries(path):
+            if isdirectory: # Directories are made up front so the workers only ever write files
+                try:
+                    outpath = self.outpath(fullpath)
+                except ValueError as e:
+                    report.errors.append((fullpath, str(e)))
+                    continue
+                try:
+                    os.makedirs(outpath)
+                except OSError:
+                    pass
+                report.dirs += 1
+            else:
+                files.append((fullpath, size, obj))
+
+        pool = ThreadPool(self.workers)
+        try:
+            for fullpath, written, sparse, error in pool.imap_unordered(self.write_file, files):
+                if error != None:
+                    report.errors.append((fullpath, error))
+                    continue
+                report.files += 1
+                report.bytes += written
+                report.sparse += sparse
+        finally:
+            pool.close()
+            pool.join()
+        report.seconds = time.time() - begin
+        return report
+
+    def outpath(self, path):
+        """ Where a file from the image goes below outdir. Names come from the image so empty, . and ..
+            components are replaced with underscores, and a ValueError is raised if the result would
+            still end up outside outdir (through a symlink already there for instance).
+        """
+        parts = [part if part not in ('', '.', '..') else '_' * max(len(part), 1) for part in path.lstrip('/').split('/')]
+        result = os.path.join(self.outdir, *parts)
+        outdir = os.path.realpath(self.outdir)
+        if not os.path.realpath(result).startswith(outdir + os.sep):
+            raise ValueError("%s would be written outside %s" % (path, self.outdir))
+        return result
+
+    def write_file(self, job):
+        """ Streams one file to disk, returns (path, bytes written, bytes left as holes, error) """
+        fullpath, size, obj = job
+        written = sparse = 0
+        try:
+            fd = os.open(self.outpath(fullpath), os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0666)
+            try:
+                os.ftruncate(fd, size) # Preallocate, anything not written below reads back as zeros
+                for chunk in self.chunks(obj):
+                    length = len(chunk)
+                    if not self.sparse:
+                        self.write_range(fd, written, chunk, 0, length)
+                        written += length
+                        continue
+                    run = None # Where the current run of pages with data started
+                    for page in xrange(0, length, self.holesize):
+                        pagelen = min(self.holesize, length - page)
+                        if chunk.count('\x00', page, page + pagelen) == pagelen:
+                            if run != None:
+                                self.write_range(fd, written, chunk, run, page)
+                                run = None
+                            sparse += pagelen
+                        elif run == None:
+                            run = page
+                    if run != None:
+                        self.write_range(fd, written, chunk, run, length)
+                    written += length
+            finally:
+                os.close(fd)
+        except Exception as e: # One bad file shouldn't stop the rest
+            return (fullpath, written, sparse, str(e))
+        return (fullpath, written, sparse, None)
+
+    def write_range(self, fd, offset, data, start, end):
+        """ Writes data[start:end] to fd at offset + start """
+        os.lseek(fd, offset + start, os.SEEK_SET)
+        while start < end: # os.write can be short
+            start += os.write(fd, buffer(data, start, end - start))
+
+def open_source(filename):
+    """ Opens filename as an STFS container if it has STFS magic, otherwise as an XTAF partition """
+    fd = open(filename, 'rb')
+    magic = fd.read(4)
+    fd.close()
+    if is_stfs(magic):
+        return STFS(filename)
+    return Partition(filename, threadsafe=True)
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3:
+        print "Usage: extract.py <STFS file or XTAF image> <output directory> [workers]"
+        print "Dumps the contents of an STFS container or XTAF partition to disk"
+        sys.exit(1)
+    workers = 4
+    if len(sys.argv) > 3:
+        workers = int(sys.argv[3])
+    print Extractor(open_source(sys.argv[1]), sys.argv[2], workers=workers).run()
@@ -0,0 +1,199 @@
+#!/usr/bin/python
+
+"""
+    Loads the achievements, titles and settings from the GPDs in every profile on a partition into SQLite
+    so questions across profiles don't need every GPD parsed again.
+    To use this try something like:
+    from gpdstore import GPDStore
+    store = GPDStore('drive.db')
+    store.ingest_partition(Partition('/mnt/data/201010.bin', threadsafe=True))
+    print store.unlocked(title_id=0x4D5307E6)
+"""
+
+import os
+import sys
+import time
+import struct
+import sqlite3
+import xboxtime
+from multiprocessing.pool import ThreadPool
+from stfs import STFS
+from xdbf import XDBF
+
+ACHIEVEMENT_UNLOCKED = 0x20000 # Achievement flag set once it has been earned (0x10000 means earned online)
+MAX_INTEGER = 2**63 - 1 # SQLite integers are signed 64 bit, bigger setting values are stored as text
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS achievements (profile TEXT, title_id INTEGER, achievement_id INTEGER, name TEXT,
+    gamer_score INTEGER, flags INTEGER, unlocked INTEGER, unlock_time REAL,
+    PRIMARY KEY (profile, title_id, achievement_id));
+CREATE TABLE IF NOT EXISTS titles (profile TEXT, title_id INTEGER, name TEXT, achievement_count INTEGER,
+    achievement_unlocked INTEGER, gamerscore_total INTEGER, gamerscore_unlocked INTEGER, last_played REAL,
+    PRIMARY KEY (profile, title_id));
+CREATE TABLE IF NOT EXISTS settings (profile TEXT, title_id INTEGER, setting_id INTEGER, content_id INTEGER, value,
+    PRIMARY KEY (profile, title_id, setting_id));
+CREATE INDEX IF NOT EXISTS achievements_title ON achievements (title_id, achievement_id, unlocked);
+CREATE INDEX IF NOT EXISTS titles_title ON titles (title_id);
+CREATE INDEX IF NOT EXISTS settings_setting ON settings (setting_id);
+"""
+
+def gpd_rows(profile, title_id, gpd):
+    """ Returns (achievement rows, title rows, setting rows) for an XDBF object """
+    achievements = []
+    for a in gpd.achievements.itervalues():
+        if a.achievement_id == None: # Not a full achievement record
+            continue
+        achievements.append((profile, title_id, a.achievement_id, a.get_name(), a.gamer_score, a.flags,\
+                             int(a.flags & ACHIEVEMENT_UNLOCKED != 0), a.unlock_time))
+    titles = [(profile, t.title_id, t.get_name(), t.achievement_count, t.achievement_unlocked, t.gamerscore_total,\
+               t.gamerscore_unlocked, xboxtime.filetime2unixtime(t.last_played)) for t in gpd.titles.itervalues()]
+    settings = []
+    for s in gpd.settings.itervalues():
+        value = s.data
+        if isinstance(value, (int, long)) and value > MAX_INTEGER:
+            value = str(value)
+        elif isinstance(value, str):
+            value = sqlite3.Binary(value)
+        settings.append((profile, title_id, s.setting_id, s.content_id, value))
+    return (achievements, titles, settings)
+
+def profile_rows(profile, container):
+    """ Returns (achievement rows, title rows, setting rows, errors) for every GPD in a profile STFS object.
+        A GPD's title id comes from its name (4D5307E6.gpd), the dashboard's is FFFE07D1.
+    """
+    achievements, titles, settings, errors = [], [], [], []
+    for path in container.walk():
+        name = os.path.basename(path)
+        if not name.lower().endswith('.gpd'):
+            continue
+        fd = container.open_fd(path)
+        if fd == None: # A directory, XDBF would fall back to opening the path on this machine
+            continue
+        try:
+            title_id = int(name[:-4], 16)
+            rows = gpd_rows(profile, title_id, XDBF(path, fd=fd))
+        except (ValueError, AssertionError, IOError, struct.error) as e: # A bad GPD shouldn't lose the rest of the profile
+            errors.append(("%s %s" % (profile, path), str(e)))
+            continue
+        achievements.extend(rows[0])
+        titles.extend(rows[1])
+        settings.extend(rows[2])
+    return (achievements, titles, settings, errors)
+
+def find_profiles(partition):
+    """ Yields (profile, path) for the profile STFS containers on a partition (see gamertags.py) """
+    content = partition.get_file('/Content')
+    if content == None:
+        return
+    for directory in content.files.keys():
+        if len(directory) == 16 and directory[0] == 'E':
+            path = '/Content/%s/FFFE07D1/00010000/%s' % (directory, directory)
+            if partition.get_file(path) != None:
+                yield (directory, path)
+
+class GPDStore(object):
+    """ An SQLite database of achievements, titles and settings keyed by profile and title id """
+    def __init__(self, filename=':memory:'):
+        self.filename = filename
+        self.db = sqlite3.connect(filename)
+        self.db.executescript(SCHEMA)
+        self.errors = []
+
+    def add_rows(self, achievements, titles, settings):
+        self.db.executemany("INSERT OR REPLACE INTO achievements VALUES (?, ?, ?, ?, ?, ?, ?, ?)", achievements)
+        self.db.executemany("INSERT OR REPLACE INTO titles VALUES (?, ?, ?, ?, ?, ?, ?, ?)", titles)
+        self.db.executemany("INSERT OR REPLACE INTO settings VALUES (?, ?, ?, ?, ?)", settings)
+
+    def add_gpd(self, profile, title_id, gpd):
+        """ Adds the contents of an XDBF object """
+        self.add_rows(*gpd_rows(profile, title_id, gpd))
+        self.db.commit()
+
+    def add_profile(self, profile, container):
+        """ Adds every GPD in a profile STFS object """
+        achievements, titles, settings, errors = profile_rows(profile, container)
+        self.add_rows(achievements, titles, settings)
+        self.errors.extend(errors)
+        self.db.commit()
+
+    def ingest_partition(self, partition, workers=8):
+        """ Adds every profile on a partition, profiles are parsed by a pool of workers while rows are
+            written as each one finishes. Returns (profiles, seconds).
+        """
+        begin = time.time()
+        workers = partition.parallel_workers(workers)
+
+        def parse(job):
+            profile, path = job
+            try:
+                return profile_rows(profile, STFS(path, fd=partition.open_fd(path)))
+            except Exception as e: # A damaged profile shouldn't stop the rest
+                return ([], [], [], [(path, str(e))])
+
+        count = 0
+        pool = ThreadPool(workers)
+        try:
+            for achievements, titles, settings, errors in pool.imap_unordered(parse, find_profiles(partition)):
+                self.add_rows(achievements, titles, settings)
+                self.errors.extend(errors)
+                count += 1
+        finally:
+            pool.close()
+            pool.join()
+            self.db.commit()
+        return (count, time.time() - begin)
+
+    def query(self, sql, *args):
+        """ Runs any SQL against the store and returns all the rows """
+        return self.db.execute(sql, args).fetchall()
+
+    def unlocked(self, title_id=None, achievement_id=None):
+        """ Returns (profile, title_id, achievement_id, name, unlock_time) for each unlocked achievement,
+            optionally just those of a title or a single achievement
+        """
+        sql = "SELECT profile, title_id, achievement_id, name, unlock_time FROM achievements WHERE unlocked = 1"
+        args = []
+        if title_id != None:
+            sql += " AND title_id = ?"
+            args.append(title_id)
+        if achievement_id != None:
+            sql += " AND achievement_id = ?"
+            args.append(achievement_id)
+        return self.query(sql + " ORDER BY unlock_time", *args)
+
+    def players(self, title_id):
+        """ Returns (profile, last_played, achievement_unlocked, gamerscore_unlocked) for each profile that played a title """
+        return self.query("SELECT profile, last_played, achievement_unlocked, gamerscore_unlocked FROM titles"\
+                          " WHERE title_id = ? ORDER BY last_played DESC", title_id)
+
+    def titles(self, profile):
+        """ Returns (title_id, name, last_played, gamerscore_unlocked, gamerscore_total) for each title a profile played """
+        return self.query("SELECT title_id, name, last_played, gamerscore_unlocked, gamerscore_total FROM titles"\
+                          " WHERE profile = ? ORDER BY last_played DESC", profile)
+
+    def setting(self, setting_id, profile=None):
+        """ Returns (profile, title_id, value) for a setting across the store or for one profile """
+        if profile == None:
+            return self.query("SELECT profile, title_id, value FROM settings WHERE setting_id = ?", setting_id)
+        return self.query("SELECT profile, title_id, value FROM settings WHERE setting_id = ? AND profile = ?",\
+                          setting_id, profile)
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3:
+        print "Usage: gpdstore.py <XTAF image> <output.db> [workers]"
+        print "Loads the achievements, titles and settings of every profile on a partition into SQLite"
+        sys.exit(1)
+    from partition import Partition
+    workers = 8
+    if len(sys.argv) > 3:
+        workers = int(sys.argv[3])
+    store = GPDStore(sys.argv[2])
+    count, seconds = store.ingest_partition(Partition(sys.argv[1], threadsafe=True), workers)
+    for path, error in store.errors:
+        print "Error reading %s: %s" % (path, error)
+    print "Loaded %d profiles in %.2fs" % (count, seconds)
+    store.close()
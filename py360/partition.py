@@ -7,78 +7,220 @@
     xtafpart = Partition('/mnt/data/201010.bin') 
 """
 
+import io
+import os
+import gc
 import sys
+import time
 import mmap
+import array
 import struct
-from threading import Lock
-from cStringIO import StringIO
-
-# TODO: Optional thread safety
-class XTAFFD(object):
-    """ A File-like object for representing FileObjs """
+import marshal
+import hashlib
+from threading import Lock, Thread, local
+from bisect import bisect_right
+from collections import OrderedDict, deque
+from multiprocessing.pool import ThreadPool
+from Queue import Queue, Full
+import xboxtime
+
+FAT_ENTRY = struct.Struct(">I") # FAT entries are 32 bit BIG ENDIAN
+# Directory entries: name length, flags, name, cluster, size, creation/access/update date and time
+FILE_RECORD = struct.Struct(">cc42sIIHHHHHH")
+INDEX_VERSION = 2 # Bump when the layout of saved directory indexes changes
+INDEX_SAMPLES = 64 # How many pages of the FAT a directory index key hashes
+
+class XTAFFD(io.RawIOBase):
+    """ A File-like object for representing FileObjs
+        It is a raw io object (with readinto) so it can be wrapped in io.BufferedReader.
+        Each XTAFFD has its own file pointer so threads should open their own.
+    """
     def __init__(self, partition, fileobj):
+        io.RawIOBase.__init__(self)
         self.pointer = 0
         self.fileobj = fileobj
         self.partition = partition
+        self.starts = extent_starts(partition.get_extents(fileobj)) # Seeks bisect these, not the extents
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
 
     def read(self, length=-1):
-        buf = self.partition.read_file(fileobj = self.fileobj, size=length, offset=self.pointer)
+        if length == None:
+            length = -1
+        buf = self.partition.read_file(fileobj = self.fileobj, size=length, offset=self.pointer, starts=self.starts)
         self.pointer += len(buf)
         return buf
 
+    def readall(self):
+        return self.read()
+
+    def readinto(self, b):
+        buf = self.read(len(b))
+        b[:len(buf)] = buf
+        return len(buf)
+
     def seek(self, offset, whence=0):
         if whence == 0:
             self.pointer = offset
         if whence == 1:
             self.pointer = self.pointer + offset
         if whence == 2:
-            self.pointer = self.fileobj.fr.fsize - offset
+            self.pointer = self.fileobj.fr.fsize + offset
 
         if self.pointer > self.fileobj.fr.fsize:
             self.pointer = self.fileobj.fr.fsize
         if self.pointer < 0:
             self.pointer = 0
+        return self.pointer
 
     def tell(self):
         return self.pointer
 
+class ClusterCache(object):
+    """ A bounded LRU cache of cluster data with hit, miss and prefetch counters
+        Also remembers where recent reads of each file ended to spot sequential readers.
+    """
+    def __str__(self):
+        return "XTAF Cluster Cache: %d/%d clusters, %d hits, %d misses, %d prefetched" %\
+               (len(self.clusters), self.size, self.hits, self.misses, self.prefetched)
+
+    def __init__(self, size, positions=256):
+        self.size = size # In clusters
+        self.clusters = OrderedDict()
+        self.positions = OrderedDict() # First cluster of a file -> end of its last read
+        self.max_positions = positions
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        self.prefetched = 0
+
+    def __contains__(self, cluster):
+        return cluster in self.clusters
+
+    def get(self, cluster):
+        """ Returns the cached cluster (or None), marking it most recently used """
+        with self.lock:
+            data = self.clusters.pop(cluster, None)
+            if data is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.clusters[cluster] = data
+            return data
+
+    def peek(self, cluster):
+        """ Returns the cached cluster (or None) without touching the counters or the LRU order """
+        return self.clusters.get(cluster)
+
+    def put(self, cluster, data):
+        """ Adds a cluster, evicting the least recently used clusters past the size limit """
+        with self.lock:
+            self.clusters.pop(cluster, None)
+            self.clusters[cluster] = data
+            while len(self.clusters) > self.size:
+                self.clusters.popitem(last=False)
+
+    def sequential(self, key, offset, end):
+        """ Records a read of offset to end of the file key, returns True if it follows the last read
+            (or is the first read from the start of the file)
+        """
+        with self.lock:
+            last = self.positions.pop(key, None)
+            self.positions[key] = end
+            if len(self.positions) > self.max_positions:
+                self.positions.popitem(last=False)
+            return last == offset or (last is None and offset == 0)
+
+    def add_prefetched(self, count):
+        with self.lock:
+            self.prefetched += count
+
+    def stats(self):
+        """ Returns a dict of the cache counters """
+        lookups = self.hits + self.misses
+        return {'clusters': len(self.clusters), 'size': self.size, 'hits': self.hits, 'misses': self.misses,
+                'prefetched': self.prefetched, 'hit_ratio': lookups and float(self.hits) / lookups}
+
 class FileRecord(object):
     """FileRecord is straight off of the disk (but with everything in host byte order)"""
+    __slots__ = ('fnsize', 'attribute', 'filename', 'cluster', 'fsize', 'mtime', 'mdate', 'ctime', 'cdate',\
+                 'atime', 'adate')
+
     def __str__(self):
         return "XTAF FileRecord: %s" % self.filename
 
-    def __init__(self, **kwargs):
-        self.fnsize = kwargs["fnsize"]
-        self.attribute = kwargs["attribute"]
-        self.filename = kwargs["filename"]
-        self.cluster = kwargs["cluster"]
-        self.fsize = kwargs["fsize"]
-        self.mtime = kwargs["mtime"]
-        self.mdate = kwargs["mdate"]
-        self.ctime = kwargs["ctime"]
-        self.cdate = kwargs["cdate"]
-        self.atime = kwargs["atime"]
-        self.adate = kwargs["adate"]
+    def __init__(self, fnsize, attribute, filename, cluster, fsize, mtime, mdate, ctime, cdate, atime, adate):
+        self.fnsize = fnsize
+        self.attribute = attribute
+        self.filename = filename
+        self.cluster = cluster
+        self.fsize = fsize
+        self.mtime = mtime
+        self.mdate = mdate
+        self.ctime = ctime
+        self.cdate = cdate
+        self.atime = atime
+        self.adate = adate
 
     def isDirectory(self):
         if self.fsize == 0:
             return True
         return False
 
+def clusters_to_extents(clusters):
+    """ Turns a list of clusters into a list of (start cluster, length) runs of contiguous clusters """
+    extents = []
+    if len(clusters) == 0:
+        return extents
+    start = prev = clusters[0]
+    for cl in clusters[1:]:
+        if cl != prev + 1:
+            extents.append((start, prev - start + 1))
+            start = cl
+        prev = cl
+    extents.append((start, prev - start + 1))
+    return extents
+
+def extent_starts(extents):
+    """ Returns the offset in the file of each extent, bisect these to find the extent holding an offset """
+    starts = []
+    offset = 0
+    for start, length in extents:
+        starts.append(offset)
+        offset += length << 14L
+    return starts
+
+NO_CLUSTERS = () # Shared by every FileObj whose clusters haven't been read
+
 class FileObj(object):
-    """ FileObj is a container with a FileRecord and a list of clusters """
+    """ FileObj is a container with a FileRecord, a list of clusters and the extents they form
+        Files loaded from a directory index only have their extents, the cluster list stays empty.
+        Partitions hold one per file so they are slotted and share NO_CLUSTERS until read.
+    """
+    __slots__ = ('fr', 'clusters', 'extents', 'fullpath')
+
     def __str__(self):
         return "XTAF File: %s" % self.fr
 
     def __init__(self, fr, clusters):
         self.fr = fr
         self.clusters = clusters
+        if len(clusters) == 0:
+            self.extents = NO_CLUSTERS
+        else:
+            self.extents = clusters_to_extents(clusters)
 
     def isDirectory(self):
         return False
 
 class Directory(FileObj):
     """ Directory is a FileObj with a dict of FileObj """
+    __slots__ = ('files', 'root')
+
     def __str__(self):
         return "%s (Directory)" % (super(Directory, self).__str__())
 
@@ -90,6 +232,51 @@ class Directory(FileObj):
     def isDirectory(self):
         return True
 
+class XTAFEntry(object):
+    """ An entry yielded by Partition.scan with the FileObj, its path and its depth below the scan
+        Sizes, clusters and decoded (unix) timestamps are read from the FileRecord on demand.
+    """
+    __slots__ = ('path', 'fileobj', 'depth')
+
+    def __str__(self):
+        return "XTAF Entry: %s" % self.path
+
+    def __init__(self, path, fileobj, depth):
+        self.path = path
+        self.fileobj = fileobj
+        self.depth = depth
+
+    @property
+    def name(self):
+        return self.fileobj.fr.filename
+
+    @property
+    def size(self):
+        return self.fileobj.fr.fsize
+
+    @property
+    def cluster(self):
+        return self.fileobj.fr.cluster
+
+    @property
+    def deleted(self):
+        return self.fileobj.fr.filename[0] == '~'
+
+    @property
+    def mtime(self):
+        return xboxtime.fat2unixtime(self.fileobj.fr.mtime, self.fileobj.fr.mdate)
+
+    @property
+    def atime(self):
+        return xboxtime.fat2unixtime(self.fileobj.fr.atime, self.fileobj.fr.adate)
+
+    @property
+    def ctime(self):
+        return xboxtime.fat2unixtime(self.fileobj.fr.ctime, self.fileobj.fr.cdate)
+
+    def isDirectory(self):
+        return self.fileobj.isDirectory()
+
 class Partition(object):
     """
         Main class representing the partition
@@ -99,7 +286,15 @@ class Partition(object):
     def __str__(self):
         return "XTAF Partition: %s" % self.filename
 
-    def __init__(self, filename, threadsafe=False, precache=False):
+    def __init__(self, filename, threadsafe=False, precache=False, cache_size=0, readahead=8, index=None,\
+                 workers=1):
+        """ cache_size is the number of bytes of clusters to cache (0 disables the cache).
+            readahead is the number of clusters to prefetch for sequential readers of a file.
+            index is the path of a directory index file. If it matches the image the tree is loaded
+            from it, otherwise the whole tree is parsed and the index is (re)written.
+            workers is the number of directory reads crawl keeps in flight when parsing the whole tree
+            (threadsafe partitions only).
+        """
         self.filename = filename
         self.threadsafe = threadsafe
         self.SIZE_OF_FAT_ENTRIES = 4
@@ -117,11 +312,16 @@ class Partition(object):
         size = end - rootdir
         fatsize = size >> 14L
 
-        # This doesn't work because unlike the C version of mmap you can't give it a 64 bit offset
-        #fatfd = mmap.mmap(fd.fileno(), fatsize, mmap.PROT_READ, mmap.PROT_READ, offset=fat)
-        # So we have to keep the whole FAT in memory during processing
-        fd.seek(fat, 0)
-        fatdata = fd.read(fatsize * 4)
+        # Map the whole image rather than the FAT alone (mmap offsets must be page aligned anyway).
+        # The FAT is then a zero-copy buffer over the map so opening a partition costs almost no memory.
+        # 32 bit builds can't map large images so fall back to keeping the whole FAT in memory.
+        try:
+            image = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+            fatdata = buffer(image, fat, fatsize * 4)
+        except (mmap.error, OverflowError, ValueError):
+            image = None
+            fd.seek(fat, 0)
+            fatdata = fd.read(fatsize * 4)
         fd.seek(0, 0)
 
         # Setup internal variables
@@ -132,92 +332,295 @@ class Partition(object):
         self.size = size
         self.fat_num = fatsize
         self.fd = fd
+        self.image = image # mmap of the image or None
         self.fat_data = fatdata # <- FAT is in BIG ENDIAN
         self.allfiles = {}
-        self.lock = Lock()
+        self.lock = Lock() # Guards directory initialisation when threadsafe
+        self.local = local() # Per thread file handles when threadsafe
+        self.cache = None
+        if cache_size >= 0x4000:
+            self.cache = ClusterCache(cache_size >> 14L)
+        self.readahead = readahead
+        self.prefetch_queue = None # Runs for the prefetch thread, started by the first prefetch
+        self.crawl_stats = None
         #self.rootfile = self.parse_directory()
-        self.rootfile = self.init_root_directory(recurse = precache)
+        if index != None and self.load_index(index):
+            self.rootfile = self.allfiles['/']
+        else:
+            recurse = precache or index != None
+            self.rootfile = self.init_root_directory(recurse = recurse and workers < 2)
+            if recurse and workers > 1:
+                self.crawl(workers = workers)
+            if index != None:
+                self.save_index(index)
 
     def read_cluster(self, cluster, length=0x4000, offset=0L):
         """ Given a cluster number returns that cluster """
         if length + offset <= 0x4000: #Sanity check
-            diskoffset = (cluster - 1 << 14L) + self.root_dir + offset
-            # Thread safety is optional because the extra function calls are a large burden
-            if self.threadsafe:
-                self.lock.acquire() 
+            return self.read_run(cluster, length, offset)
+        else:
+            return ""
 
-            try:
-                self.fd.seek(diskoffset)
-                buf = self.fd.read(length)
-            except IOError:
-                buf = ""
-
-            if self.threadsafe:
-                self.lock.release()
-            return buf
+    def read_run(self, cluster, length, offset=0L):
+        """ Reads length bytes starting offset bytes into a run of contiguous clusters """
+        if self.cache is not None:
+            return self.read_cached_run(cluster, length, offset)
+        return self.read_disk((cluster - 1 << 14L) + self.root_dir + offset, length)
+
+    def read_cached_run(self, cluster, length, offset=0L):
+        """ read_run through the cluster cache, runs larger than the cache bypass it """
+        first = cluster + (offset >> 14L)
+        count = ((offset + length - 1) >> 14L) - (offset >> 14L) + 1
+        diskoffset = (cluster - 1 << 14L) + self.root_dir + offset
+        if count > self.cache.size:
+            return self.read_disk(diskoffset, length)
+
+        bufs = [self.cache.get(cl) for cl in xrange(first, first + count)]
+        if None in bufs:
+            self.fill_cache(first, count)
+            bufs = [self.cache.peek(cl) for cl in xrange(first, first + count)]
+            if None in bufs: # Another thread evicted part of the run
+                return self.read_disk(diskoffset, length)
+        skip = offset & 0x3FFF
+        return "".join(bufs)[skip:skip + length]
+
+    def fill_cache(self, cluster, count):
+        """ Reads the clusters of a run that aren't cached into the cache, one read per gap.
+            Returns the number of clusters read.
+        """
+        end = cluster + count
+        read = 0
+        while cluster < end:
+            if cluster in self.cache:
+                cluster += 1
+                continue
+            gap = cluster + 1
+            while gap < end and gap not in self.cache:
+                gap += 1
+            run = self.read_disk((cluster - 1 << 14L) + self.root_dir, gap - cluster << 14L)
+            for i in xrange(gap - cluster):
+                self.cache.put(cluster + i, run[i << 14L:i + 1 << 14L])
+            read += gap - cluster
+            cluster = gap
+        return read
+
+    def prefetch(self, extents, offset, count):
+        """ Queues count clusters from offset bytes into a list of extents to be read into the cache
+            by the prefetch thread, so the reader doesn't wait for them. Readahead is only a hint so
+            runs are dropped if the thread has fallen behind.
+        """
+        runs = []
+        extent_offset = 0
+        for start, length in extents:
+            extent_size = length << 14L
+            if offset < extent_offset + extent_size:
+                skip = (offset - extent_offset) >> 14L
+                n = min(length - skip, count)
+                runs.append((start + skip, n))
+                offset += n << 14L
+                count -= n
+                if count <= 0:
+                    break
+            extent_offset += extent_size
+        if len(runs) == 0:
+            return
+        if self.prefetch_queue is None:
+            with self.lock:
+                if self.prefetch_queue is None:
+                    queue = Queue(64)
+                    thread = Thread(target=self.prefetch_worker, args=(queue,))
+                    thread.daemon = True
+                    thread.start()
+                    self.prefetch_queue = queue
+        try:
+            self.prefetch_queue.put_nowait(runs)
+        except Full:
+            pass
+
+    def prefetch_worker(self, queue):
+        """ The prefetch thread, reads queued runs into the cache through its own file handle """
+        self.local.fd = open(self.filename, 'r')
+        while True:
+            for cluster, count in queue.get():
+                try:
+                    self.cache.add_prefetched(self.fill_cache(cluster, count))
+                except Exception as e: # Keep the thread alive for later runs
+                    print "Prefetch error: %d %s" % (cluster, e)
+
+    def read_disk(self, diskoffset, length):
+        """ Reads length bytes from diskoffset bytes into the image """
+        # Threads with their own handle (every thread when threadsafe, and the prefetch thread) seek
+        # and read it so no lock is needed. Slicing the map would hold the GIL through every page fault,
+        # file reads release it.
+        fd = getattr(self.local, 'fd', None)
+        if fd is not None:
+            pass
+        elif self.threadsafe:
+            fd = self.local.fd = open(self.filename, 'r')
+        elif self.image is not None:
+            return self.image[diskoffset:diskoffset + length]
         else:
+            fd = self.fd
+
+        try:
+            fd.seek(diskoffset)
+            return fd.read(length)
+        except IOError:
             return ""
 
-    #TODO: Refactor into something smaller
-    def read_file(self, filename=None, fileobj=None, size=-1, offset=0):
-        """ Reads an entire file given a filename or fileobj """
+    def read_file(self, filename=None, fileobj=None, size=-1, offset=0, starts=None):
+        """ Reads an entire file given a filename or fileobj.
+            Reads are made per extent so a contiguous file takes a single read.
+            starts (see extent_starts) lets repeated reads skip straight to the extent they need.
+        """
         #TODO: Error checking
         if not fileobj: 
             fileobj = self.get_file(filename)
 
-        if size == -1:
-            if fileobj.isDirectory():
+        if fileobj.isDirectory():
+            if size == -1:
                 size = 2**32 # Read the whole directory (all the clusters)
-            else:
-                size = fileobj.fr.fsize # Read the whole file (skip the slack space)
+        else:
+            # Read the whole file or the portion requested (but never the slack space)
+            if size == -1 or size > fileobj.fr.fsize - offset:
+                size = fileobj.fr.fsize - offset
+        if size <= 0:
+            return ""
 
-        if len(fileobj.clusters) == 0: # Initialise cluster list if necessary
-            fileobj.clusters = self.get_clusters(fileobj.fr)
-            if len(fileobj.clusters) == 0: # Check the return of get_clusters
-                print "Reading Empty File"
-                return ""
+        extents = self.get_extents(fileobj)
+        if len(extents) == 0: # Check the return of get_clusters
+            print "Reading Empty File"
+            return ""
+        buf = self.read_extents(extents, size, offset, starts)
 
-        clusters_to_skip = offset // 0x4000
-        offset %= 0x4000
-        buf = StringIO() 
-        try:
-            readlen = min(0x4000, size)
-            buf.write(self.read_cluster(fileobj.clusters[clusters_to_skip], readlen, offset))
-            size -= readlen
-            for cl in fileobj.clusters[clusters_to_skip+1:]:
-                if size <= 0:
-                    break # If we're finished, stop reading clusters
-                readlen = min(0x4000, size)
-                buf.write(self.read_cluster(cl, readlen, 0))
+        # Readers working through a file in order get the next clusters of the file cached ahead of time
+        if self.cache is not None and self.readahead > 0 and not fileobj.isDirectory():
+            if self.cache.sequential(fileobj.fr.cluster, offset, offset + len(buf)):
+                self.prefetch(extents, offset + len(buf), self.readahead)
+        return buf
+
+    def iter_file(self, filename=None, fileobj=None, chunksize=0x100000):
+        """ A generator that yields a file in chunks of at most chunksize bytes.
+            Memory use is constant however big the file is, each chunk comes from a single extent.
+        """
+        if not fileobj:
+            fileobj = self.get_file(filename)
+        if fileobj.isDirectory():
+            size = 2**32
+        else:
+            size = fileobj.fr.fsize
+
+        for start, length in self.get_extents(fileobj):
+            extent_size = min(length << 14L, size)
+            pos = 0
+            while pos < extent_size:
+                readlen = min(chunksize, extent_size - pos)
+                yield self.read_run(start, readlen, pos)
+                pos += readlen
+            size -= extent_size
+            if size <= 0:
+                break
+
+    def get_extents(self, fileobj):
+        """ Returns the extents of a fileobj, initialising its cluster list if necessary """
+        extents = fileobj.extents
+        if len(extents) == 0:
+            clusters = self.get_clusters(fileobj.fr)
+            extents = clusters_to_extents(clusters)
+            if len(clusters) > 0 and not fileobj.isDirectory(): # Directories are marked as parsed elsewhere
+                fileobj.extents = extents
+                fileobj.clusters = clusters
+        return extents
+
+    def read_extents(self, extents, size, offset=0, starts=None):
+        """ Reads size bytes from offset bytes into a list of extents, one read per extent """
+        bufs = []
+        first = 0
+        extent_offset = 0 # Offset of the current extent in the file
+        if starts != None and len(starts) > 0: # Skip the extents before offset
+            first = max(bisect_right(starts, offset) - 1, 0)
+            extent_offset = starts[first]
+        for i in xrange(first, len(extents)):
+            start, length = extents[i]
+            extent_size = length << 14L
+            if offset < extent_offset + extent_size:
+                skip = offset - extent_offset
+                readlen = min(extent_size - skip, size)
+                bufs.append(self.read_run(start, readlen, skip))
+                offset += readlen
                 size -= readlen
-            return buf.getvalue()
-        except IndexError:
-            print "Read overflow?", len(fileobj.clusters), clusters_to_skip
-            return buf.getvalue()
+                if size <= 0:
+                    break # If we're finished, stop reading extents
+            extent_offset += extent_size
+
+        if len(bufs) == 1:
+            return bufs[0]
+        return "".join(bufs)
 
     def get_clusters(self, fr):
         """ Builds a list of the clusters a file hash by parsing the FAT """
         if fr.cluster == 0:
             print "Empty file"
             return []
+        # Local names keep the chain walk tight, unpack_from reads straight out of the FAT buffer
+        unpack_fat = FAT_ENTRY.unpack_from
+        fat_data = self.fat_data
+        fat_len = len(fat_data)
         clusters = [fr.cluster]
-        cl = 0x0
+        append = clusters.append
         cl = fr.cluster
-        cldata = ''
-        while cl & 0xFFFFFFF != 0xFFFFFFF:
-            cl_off = cl * self.SIZE_OF_FAT_ENTRIES 
-            cldata = self.fat_data[cl_off:cl_off + self.SIZE_OF_FAT_ENTRIES]
-            if len(cldata) == 4:
-                cl = struct.unpack(">I", cldata)[0] 
-                if cl & 0xFFFFFFF != 0xFFFFFFF:
-                    clusters.append(cl)
-            else:
+        while True:
+            cl_off = cl * self.SIZE_OF_FAT_ENTRIES
+            if cl_off + self.SIZE_OF_FAT_ENTRIES > fat_len:
                 if fr.filename[0] != '~':
-                    print "get_clusters fat offset warning %s %x vs %x, %x" %\
-                          (fr.filename, cl_off, len(self.fat_data), len(cldata))
-                cl = 0xFFFFFFF
+                    print "get_clusters fat offset warning %s %x vs %x" % (fr.filename, cl_off, fat_len)
+                break
+            cl = unpack_fat(fat_data, cl_off)[0]
+            if cl & 0xFFFFFFF == 0xFFFFFFF or cl == 0: # A free entry is a broken chain (deleted files)
+                break
+            append(cl)
         return clusters
 
+    def get_fat_array(self):
+        """ Returns the whole FAT as an array of host byte order integers.
+            This is a copy of the FAT, use it for passes over every entry (free space, every chain).
+            Following a single chain is cheaper with get_clusters.
+        """
+        fat = array.array('I')
+        fat.fromstring(self.fat_data[:])
+        if sys.byteorder == 'little':
+            fat.byteswap()
+        return fat
+
+    def get_all_clusters(self, fileobjs):
+        """ Resolves the cluster lists of many FileObjs in one pass over a host order copy of the FAT
+            Directories are skipped, an empty cluster list marks a directory that hasn't been parsed.
+        """
+        fat = self.get_fat_array()
+        fat_num = len(fat)
+        for f in fileobjs:
+            if f.isDirectory() or len(f.clusters) > 0 or f.fr.cluster == 0:
+                continue
+            cl = f.fr.cluster
+            clusters = [cl]
+            append = clusters.append
+            while cl < fat_num:
+                cl = fat[cl]
+                if cl & 0xFFFFFFF == 0xFFFFFFF or cl == 0:
+                    break
+                append(cl)
+            f.clusters = clusters
+            f.extents = clusters_to_extents(clusters)
+
+    def parallel_workers(self, workers):
+        """ Returns how many threads can usefully read this partition at once, workers when it is
+            threadsafe and 1 otherwise. Without per thread file handles every read shares one handle,
+            and slicing the map holds the GIL through page faults, so extra threads would only take turns.
+        """
+        if self.threadsafe:
+            return workers
+        return 1
+
     def open_fd(self, filename):
         f = self.get_file(filename)
         """ Return an XTAFFD object for a file """
@@ -231,41 +634,23 @@ class Partition(object):
             While not end of file records
             Create a file record object
             Return list of file records
+            Records are decoded straight out of data with one precompiled struct per record
             Date format: 
         """
         file_records = []
-        pos = 0
-        while pos + 64 < len(data): # FileRecord struct offsets
-            fnlen = data[pos]
-            flags = data[pos+1]
-            if ord(fnlen) == 0xE5: # Handle deleted files
-                name = '~' + data[pos+2:pos+2+42].strip("\xff\x00")
+        append = file_records.append
+        unpack_record = FILE_RECORD.unpack_from
+        for pos in xrange(0, len(data) - 64, 64): # FileRecord struct offsets
+            fnlen, flags, name, cl, size, cdate, ctime, adate, atime, udate, utime = unpack_record(data, pos)
+            if fnlen == '\xe5': # Handle deleted files
+                name = '~' + name.strip("\xff\x00")
+            elif fnlen == '\x00': # A vacant entry, maybe the end of the directory?
+                continue
             elif ord(fnlen) > 42: # Technically >42 should be an error condition
                 break
-            elif ord(fnlen) == 0: # A vacant entry, maybe the end of the directory?
-                pos += 64
-                continue
             else: 
-                name = data[pos+2:pos+2+42].strip("\xff\x00") # Ignoring fnlen is a bit wasteful
-            cl = struct.unpack(">I", data[pos+0x2c:pos+0x2c+4])[0]
-            size = struct.unpack(">I", data[pos+0x30:pos+0x30+4])[0]
-            creation_date = struct.unpack(">H", data[pos+0x34:pos+0x34+2])[0]
-            creation_time = struct.unpack(">H", data[pos+0x36:pos+0x36+2])[0]
-            access_date = struct.unpack(">H", data[pos+0x38:pos+0x38+2])[0]
-            access_time = struct.unpack(">H", data[pos+0x3A:pos+0x3A+2])[0]
-            update_date = struct.unpack(">H", data[pos+0x3C:pos+0x3C+2])[0]
-            update_time = struct.unpack(">H", data[pos+0x3E:pos+0x3E+2])[0]
-
-            #if not (fnlen == '\xff' and flags == '\xff') and not fnlen == '\x00':
-            if (ord(fnlen) < 43 and ord(fnlen) != 0) or (ord(fnlen) == 0xE5):
-                file_records.append(FileRecord(fnsize=fnlen, attribute=flags, filename=name, cluster=cl,\
-                                               fsize=size, mtime=update_time, mdate=update_date,\
-                                               adate=access_date, atime=access_time,\
-                                               cdate=creation_date, ctime=creation_time))
-            else:
-                pass
-
-            pos += 64
+                name = name.strip("\xff\x00") # Ignoring fnlen is a bit wasteful
+            append(FileRecord(fnlen, flags, name, cl, size, utime, udate, ctime, cdate, atime, adate))
 
         return file_records
 
@@ -276,24 +661,47 @@ class Partition(object):
             self.allfiles can still be used if the partition is created with precache = True
             Using this will eliminate much of the advantage of precache = False.
             The only remaining speedup will be the lazy caching of file cluster lists
+            See scan for a version that yields the fileobjs themselves.
         """
         f = self.get_file(path)
         if f == None or not f.isDirectory():
             return
-        files = [f]
+        files = deque([f])
 
         while len(files) > 0:
-            f = files.pop(0)
+            f = files.popleft()
             if f.isDirectory():
-                if not f.root and len(f.clusters) == 0:
-                    f = self.parse_directory(f) 
-                files = files + f.files.values()
+                f = self.init_directory(f)
+                files.extend(f.files.itervalues())
             yield f.fullpath
 
         return 
 
-            
-
+    def scan(self, path = '/', maxdepth = None, prune = None, deleted = False):
+        """ A generator that yields an XTAFEntry for every file and directory below path (breadth first).
+            maxdepth limits how deep to go (1 is just the contents of path).
+            prune is a function taking an XTAFEntry, if it returns True the entry and everything
+            below it are skipped.
+            Deleted (~) entries are skipped unless deleted is True.
+        """
+        top = self.get_file(path)
+        if top == None or not top.isDirectory():
+            return
+        directories = deque([(top, 0)])
+
+        while len(directories) > 0:
+            d, depth = directories.popleft()
+            d = self.init_directory(d)
+            depth += 1
+            for f in d.files.itervalues():
+                if not deleted and f.fr.filename[0] == '~':
+                    continue
+                entry = XTAFEntry(f.fullpath, f, depth)
+                if prune != None and prune(entry):
+                    continue
+                if f.isDirectory() and (maxdepth == None or depth < maxdepth):
+                    directories.append((f, depth))
+                yield entry
 
     def get_file(self, filename):
         """ Returns a fileobj from a filename. 
@@ -301,9 +709,9 @@ class Partition(object):
             Not the same as self.allfiles[filename] anymore. """
         if filename in self.allfiles: 
             currentfile = self.allfiles[filename]
-            if currentfile.isDirectory() and not currentfile.root and len(currentfile.clusters) == 0:
+            if currentfile.isDirectory():
                 # If we're asked for a directory, initialise it before returning
-                currentfile = self.parse_directory(currentfile) 
+                currentfile = self.init_directory(currentfile)
             return currentfile # A previously accessed file
         else:
             return self.walk_for_file(filename)
@@ -318,19 +726,34 @@ class Partition(object):
             if currentfile == None:
                 break
             # If this is a directory (that isn't root) and it has no clusters listed, try to initialise it
-            if currentfile.isDirectory() and not currentfile.root and len(currentfile.clusters) == 0:
-                currentfile = self.parse_directory(currentfile)
+            if currentfile.isDirectory():
+                currentfile = self.init_directory(currentfile)
             try:
                 currentfile = currentfile.files[component]
             except KeyError:
                 currentfile = None
 
         if currentfile != None and currentfile.isDirectory():
-            print "Initialising: %s" % filename
-            currentfile = self.parse_directory(currentfile) # If we're asked for a directory, initialise it before returning
+            currentfile = self.init_directory(currentfile) # If we're asked for a directory, initialise it before returning
 
         return currentfile
 
+    def init_directory(self, directory):
+        """ Parses a directory unless it has been already.
+            add_directory_records sets the cluster list last, so a directory with clusters is completely parsed.
+            In threadsafe mode the directory is read without the lock and only the first thread to
+            take the lock adds its records.
+        """
+        if directory.root or len(directory.clusters) > 0:
+            return directory
+        if not self.threadsafe:
+            return self.parse_directory(directory)
+        data = self.read_directory(directory)
+        with self.lock:
+            if len(directory.clusters) == 0:
+                self.add_directory_records(directory, *data)
+        return directory
+
 
     def init_root_directory(self, recurse = False):
         """ Creates the root directory object and calls parse_directory on it """
@@ -341,7 +764,101 @@ class Partition(object):
         directory = self.parse_directory(directory, recurse = recurse)
         return directory 
 
-    #TODO: Refactor this to something smaller
+    def index_key(self):
+        """ Returns the (image size, image mtime, volume header, FAT size, FAT sample hash) tuple a directory
+            index has to match. The volume header holds the serial number. Only INDEX_SAMPLES evenly spaced
+            4 KiB pages of the FAT are hashed so the key costs the same however big the drive is.
+        """
+        st = os.fstat(self.fd.fileno())
+        fat = self.fat_data
+        pages = (len(fat) + 0xFFF) >> 12
+        sample = hashlib.sha1()
+        for page in sorted(set(i * pages // INDEX_SAMPLES for i in xrange(INDEX_SAMPLES))):
+            sample.update(fat[page << 12:page + 1 << 12])
+        return (st.st_size, st.st_mtime, self.read_disk(self.start, 0x10), len(fat), sample.hexdigest())
+
+    def save_index(self, filename):
+        """ Writes the parsed directory tree and the extents of every file to a directory index.
+            Directories that haven't been parsed stay unparsed when the index is loaded.
+        """
+        files = []
+        directories = [self.rootfile]
+        while len(directories) > 0:
+            d = directories.pop()
+            for f in d.files.itervalues():
+                if f.isDirectory():
+                    directories.append(f)
+                else:
+                    files.append(f)
+        self.get_all_clusters(files) # One pass over the FAT for every chain
+
+        # Records are written parents first: parent path, FileRecord fields, extents (None if unparsed)
+        records = []
+        directories = [self.rootfile]
+        while len(directories) > 0:
+            d = directories.pop()
+            for f in d.files.itervalues():
+                fr = f.fr
+                if f.isDirectory():
+                    directories.append(f)
+                    extents = f.extents if len(f.clusters) > 0 else None
+                else:
+                    extents = f.extents
+                records.append((d.fullpath, fr.fnsize, fr.attribute, fr.filename, fr.cluster, fr.fsize,\
+                                fr.mtime, fr.mdate, fr.ctime, fr.cdate, fr.atime, fr.adate, extents))
+
+        tmpname = filename + '.tmp'
+        with open(tmpname, 'wb') as fd:
+            marshal.dump((INDEX_VERSION, self.index_key(), records), fd, 2)
+        os.rename(tmpname, filename)
+
+    def load_index(self, filename):
+        """ Loads the directory tree from a directory index.
+            Returns False if the index is missing, damaged or doesn't match this image.
+        """
+        try:
+            with open(filename, 'rb') as fd:
+                version, key, records = marshal.load(fd)
+        except (IOError, EOFError, ValueError, TypeError):
+            return False
+        if version != INDEX_VERSION or key != self.index_key():
+            return False
+
+        root = Directory(None, [self.root_dir_cluster])
+        root.root = True
+        root.fullpath = '/'
+        allfiles = {'/': root}
+        gc_enabled = gc.isenabled()
+        gc.disable() # See parse_directory
+        try:
+            self.add_index_records(allfiles, records)
+        finally:
+            if gc_enabled:
+                gc.enable()
+        self.allfiles = allfiles
+        return True
+
+    def add_index_records(self, allfiles, records):
+        """ Builds FileObjs and Directorys from directory index records into allfiles """
+        for record in records:
+            parent = allfiles[record[0]]
+            fr = FileRecord(*record[1:12])
+            extents = record[12]
+            if fr.isDirectory():
+                f = Directory(fr, NO_CLUSTERS)
+                if extents != None: # Expanding the clusters marks the directory as parsed
+                    f.clusters = [cl for start, length in extents for cl in xrange(start, start + length)]
+                    f.extents = extents
+            else:
+                f = FileObj(fr, NO_CLUSTERS)
+                f.extents = extents
+            if parent.root:
+                f.fullpath = '/' + fr.filename
+            else:
+                f.fullpath = parent.fullpath + '/' + fr.filename
+            parent.files[fr.filename] = f
+            allfiles[f.fullpath] = f
+
     def parse_directory(self, directory = None, recurse = False):
         """ Parses a single directory, optionally it can recurse into subdirectories.
             It populates the allfile dict and parses the directories and file records of the directory """
@@ -351,27 +868,100 @@ class Partition(object):
         else:
             dirs_to_process.append(directory)
 
-        # For each directory to process (will be only one unless recurse is True)
-        while len(dirs_to_process) > 0:
-            d = dirs_to_process.pop(0)
-            if d.root:
-                directory_data = self.read_cluster(self.root_dir_cluster)
-            else:
-                directory_data = self.read_file(fileobj = d)
-
-            # Parse the file records returned and optionally requeue subdirectories
-            file_records = self.parse_file_records(directory_data)
-            for fr in file_records:
-                if fr.isDirectory():
-                    d.files[fr.filename] = Directory(fr, [])
-                    if recurse:
-                        dirs_to_process.append(d.files[fr.filename])
-                else:
-                    d.files[fr.filename] = FileObj(fr, [])
-                if d.root:
-                    d.files[fr.filename].fullpath = d.fullpath + fr.filename
-                else:
-                    d.files[fr.filename].fullpath = d.fullpath + '/' + fr.filename
-                self.allfiles[d.files[fr.filename].fullpath] = d.files[fr.filename]
+        # The tree only grows here so the cyclic GC would just rescan it, pause it for whole tree parses
+        gc_enabled = recurse and gc.isenabled()
+        if gc_enabled:
+            gc.disable()
+        try:
+            # For each directory to process (will be only one unless recurse is True)
+            dirs_to_process = deque(dirs_to_process)
+            while len(dirs_to_process) > 0:
+                d = dirs_to_process.popleft()
+                subdirectories = self.add_directory_records(d, *self.read_directory(d))
+                if recurse:
+                    dirs_to_process.extend(subdirectories)
+        finally:
+            if gc_enabled:
+                gc.enable()
         return directory
 
+    def read_directory(self, d):
+        """ Returns the clusters, extents and data of a directory """
+        if d.root:
+            return None, None, self.read_cluster(self.root_dir_cluster)
+        clusters = self.get_clusters(d.fr)
+        extents = clusters_to_extents(clusters)
+        return clusters, extents, self.read_extents(extents, len(clusters) << 14L)
+
+    def add_directory_records(self, d, clusters, extents, directory_data):
+        """ Parses the file records in directory data into d.files and allfiles.
+            Returns the subdirectories found.
+        """
+        subdirectories = []
+        file_records = self.parse_file_records(directory_data)
+        for fr in file_records:
+            if fr.isDirectory():
+                d.files[fr.filename] = Directory(fr, NO_CLUSTERS)
+                subdirectories.append(d.files[fr.filename])
+            else:
+                d.files[fr.filename] = FileObj(fr, NO_CLUSTERS)
+            if d.root:
+                d.files[fr.filename].fullpath = d.fullpath + fr.filename
+            else:
+                d.files[fr.filename].fullpath = d.fullpath + '/' + fr.filename
+            self.allfiles[d.files[fr.filename].fullpath] = d.files[fr.filename]
+        if not d.root: # The cluster list marks the directory as parsed so it is set last
+            d.extents = extents
+            d.clusters = clusters
+        return subdirectories
+
+    def crawl(self, path = '/', workers = 8):
+        """ Parses every directory below path keeping up to workers directory reads in flight.
+            Reads only overlap on threadsafe partitions (see parallel_workers), otherwise one
+            directory is read at a time. Records are added to the tree under the partition lock.
+            Returns (directories, seconds, directories per second), also kept in self.crawl_stats.
+        """
+        begin = time.time()
+        top = self.get_file(path)
+        if top == None or not top.isDirectory():
+            return (0, 0.0, 0.0)
+        workers = self.parallel_workers(workers)
+
+        def parse(d):
+            """ Reads and adds a directory unless it has been already, returns its subdirectories """
+            try:
+                if d.root or len(d.clusters) > 0:
+                    return [f for f in d.files.itervalues() if f.isDirectory()]
+                data = self.read_directory(d)
+                with self.lock:
+                    if len(d.clusters) == 0:
+                        return self.add_directory_records(d, *data)
+                return [f for f in d.files.itervalues() if f.isDirectory()]
+            except Exception as e: # A lost result would leave the crawl waiting forever
+                print "Crawl error: %s %s" % (d.fullpath, e)
+                return []
+
+        gc_enabled = gc.isenabled()
+        gc.disable() # See parse_directory
+        pool = ThreadPool(workers)
+        try:
+            results = Queue()
+            pool.apply_async(parse, (top,), callback=results.put)
+            pending = 1
+            count = 0
+            while pending > 0:
+                subdirectories = results.get()
+                pending -= 1
+                count += 1
+                for subdirectory in subdirectories:
+                    pool.apply_async(parse, (subdirectory,), callback=results.put)
+                    pending += 1
+        finally:
+            pool.close()
+            pool.join()
+            if gc_enabled:
+                gc.enable()
+
+        elapsed = time.time() - begin
+        self.crawl_stats = (count, elapsed, elapsed and count / elapsed)
+        return self.crawl_stats
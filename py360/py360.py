@@ -38,7 +38,9 @@ class Py360(Fuse):
     def __init__(self, *args, **kw):
         filename = kw.pop('filename')
         Fuse.__init__(self, *args, **kw)
-        self.partition = Partition(filename, threadsafe = False)
+        # Fuse reads 128kb (8 cluster) chunks, the cache smooths out chunks that split clusters
+        # and reads ahead of sequential readers. Check self.partition.cache.stats() to size it.
+        self.partition = Partition(filename, threadsafe = True, cache_size = 64 * 2**20, readahead = 8)
 
 
     def getattr(self, path):
@@ -91,14 +93,14 @@ Python FUSE file system for Xbox 360 hard drives (XFAT)
                      usage=usage,
                      dash_s_do='setsingle')
 
-    # While Partition is (now) thread safe, testing showed that single threaded
-    # mode was 6 times faster. This is because only one cluster could be read
-    # at a time regardless of number of threads. With a file object pool or a
-    # file cache this might swing the other way.
-    # If implementing this remember Fuse loves to read in 128kb chunks.
+    # Single threaded mode used to be 6 times faster because Partition read
+    # every cluster through one file handle behind one lock. In threadsafe mode
+    # each thread now reads through its own handle without a lock and directory
+    # parsing is locked per directory, so reads run concurrently.
+    # Remember Fuse loves to read in 128kb chunks.
     # 
     # Partition is only optionally threadsafe
-    server.multithreaded = False 
+    server.multithreaded = True
     server.parse(errex=1)
     server.main()
 
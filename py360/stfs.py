@@ -2,12 +2,22 @@
 Secure Transacted File System - A container format found on Xbox 360 XTAF partitions
 See http://free60.org/STFS
 """
+import io
+import time
+import array
 import struct
 from constants import ContentTypes, STFSHashInfo
 import hashlib
 from cStringIO import StringIO
+from threading import RLock
+from collections import deque
+from multiprocessing.pool import ThreadPool
 
-# TODO: Handle verifying non-data blocks
+# A hash table block holds 0xAA records of a SHA1 hash, an info byte and a 3 byte next block.
+# Reading each record's info byte and next block as one big endian int decodes a table in one call.
+HASH_TABLE = struct.Struct(">" + "20xI" * 0xAA)
+# Maps an info byte to its STFSHashInfo.types_list index (0 unused, 1 freed, 2 old, 3 current) with str.translate
+BLOCK_STATE = "".join(chr(info >> 6) for info in xrange(0x100))
 
 class BlockHashRecord(object):
     """ Object containing the SHA1 hash of a block as well as its free/used information and next block """
@@ -37,10 +47,13 @@ class FileListing(object):
     def __str__(self):
         return "STFS File Listing: %s" % self.filename
 
-    def __init__(self, data):
+    def __init__(self, data, record=-1, deleted=False):
         self.filename = data[:0x28].strip('\x00')
-        assert self.filename != '', "FileListing has empty filename"
+        assert deleted or self.filename != '', "FileListing has empty filename"
+        self.record = record # Index of the listing in the file table, what pathindex refers to
+        self.deleted = deleted
         self.isdirectory = 0x80 & ord(data[0x28]) == 0x80
+        self.consecutive = 0x40 & ord(data[0x28]) == 0x40 # The blocks follow each other
         self.numblocks = struct.unpack("<I", "%s\x00" % data[0x29:0x29+3])[0] # More little endian madness!
         self.firstblock = struct.unpack("<I", "%s\x00" % data[0x2F:0x2F+3])[0]# And again!
         self.pathindex = struct.unpack(">h", data[0x32:0x34])[0] # Signedness is important here
@@ -50,44 +63,178 @@ class FileListing(object):
         self.adate = struct.unpack(">H", data[0x3C:0x3E])[0]
         self.atime = struct.unpack(">H", data[0x3E:0x40])[0]
 
+class STFSFD(io.RawIOBase):
+    """ A File-like object for reading a file inside an STFS container (see STFS.open_fd)
+        The block chain is resolved once so seeks go straight to the right block.
+    """
+    def __init__(self, stfs, filelisting):
+        io.RawIOBase.__init__(self)
+        self.pointer = 0
+        self.stfs = stfs
+        self.filelisting = filelisting
+        self.size = filelisting.size
+        self.blocks = stfs.get_chain(filelisting.firstblock, (self.size + 0xFFF) >> 12)
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def read(self, length=-1):
+        if length == None or length < 0 or length > self.size - self.pointer:
+            length = max(self.size - self.pointer, 0)
+        if length == 0:
+            return ""
+        first = self.pointer >> 12
+        skip = self.pointer & 0xFFF
+        blocks = self.blocks[first:(self.pointer + length + 0xFFF) >> 12]
+        buf = self.stfs.read_blocks(blocks, skip + length)[skip:]
+        self.pointer += len(buf)
+        return buf
+
+    def readall(self):
+        return self.read()
+
+    def readinto(self, b):
+        buf = self.read(len(b))
+        b[:len(buf)] = buf
+        return len(buf)
+
+    def seek(self, offset, whence=0):
+        if whence == 0:
+            self.pointer = offset
+        if whence == 1:
+            self.pointer = self.pointer + offset
+        if whence == 2:
+            self.pointer = self.size + offset
+
+        if self.pointer > self.size:
+            self.pointer = self.size
+        if self.pointer < 0:
+            self.pointer = 0
+        return self.pointer
+
+    def tell(self):
+        return self.pointer
+
+class VerifyReport(object):
+    """ The result of STFS.verify
+        blocks has an entry per block: 1 passed, 0 failed, -1 not checked (not in use)
+        tables maps hash table block numbers to True/False, top is whether the top table matched
+        the header's tophashtable_hash (None if there was no table to check)
+    """
+    def __str__(self):
+        return "STFS Verification: top %s, %d/%d tables, %d blocks passed, %d failed, %d unchecked, %.1f MB/s" %\
+               (self.top, self.tables.values().count(True), len(self.tables), self.blocks.count(1),\
+                self.blocks.count(0), self.blocks.count(-1), self.throughput() / 2**20)
+
+    def __init__(self, count):
+        self.blocks = array.array('b', [-1]) * count
+        self.tables = {}
+        self.top = None
+        self.bytes = 0
+        self.seconds = 0.0
+
+    def throughput(self):
+        """ Bytes hashed per second """
+        if self.seconds > 0:
+            return self.bytes / self.seconds
+        return 0.0
+
+    def failed_blocks(self):
+        return [block for block, result in enumerate(self.blocks) if result == 0]
+
+    def passed(self):
+        """ True if the top table matched and nothing below it failed """
+        return self.top == True and False not in self.tables.values() and 0 not in self.blocks
+
+class DeletedFile(object):
+    """ A listing found with its name cleared and the blocks it (probably) had, see STFS.recover
+        overwritten is how many of those blocks now belong to a file that hasn't been deleted
+    """
+    def __str__(self):
+        return "STFS Deleted File: %s (%d blocks, %d overwritten)" % (self.path, len(self.blocks), self.overwritten)
+
+    def __init__(self, listing, path, blocks, overwritten):
+        self.listing = listing
+        self.path = path
+        self.blocks = blocks
+        self.overwritten = overwritten
+
+class RecoveryReport(object):
+    """ The result of STFS.recover
+        states has an entry per block, its STFSHashInfo.types_list index (0 unused, 1 freed, 2 old, 3 current)
+        deleted is a list of DeletedFile and orphans the blocks in use that no file or the file table reaches
+    """
+    def __str__(self):
+        return "STFS Recovery: %d blocks (%s), %d deleted files, %d orphaned blocks, %.2fs" %\
+               (len(self.states), ", ".join("%d %s" % (self.states.count(state), name) for state, name in\
+               enumerate(STFSHashInfo.types_list)), len(self.deleted), len(self.orphans), self.seconds)
+
+    def __init__(self, states):
+        self.states = states
+        self.deleted = []
+        self.orphans = []
+        self.seconds = 0.0
+
 class STFS(object):
     """ Object representing the STFS container. allfiles dict contains a path to filelisting map """
     def __str__(self):
         return "STFS Object %s (%s)" % (self.magic, self.filename)
     
-    def __init__(self, filename, fd=None):
-        """ Takes either a filename to open or a file object (including StringIO) to parse """
+    # Header fields after the fixed part of the header (images and v2 names) that a lazy open skips
+    LAZY_HEADER = ('thumbnail', 'titleimage', 'additional_display_names', 'additional_display_descriptions')
+
+    def __init__(self, filename, fd=None, lazy=False):
+        """ Takes either a filename to open or a file object (including StringIO) to parse
+            A lazy open reads just the fixed part of the header (one 0x171A byte read). The images,
+            the file table and the block map are read the first time they're used.
+        """
         self.filename = filename
+        self.lock = RLock() # Reads seek the shared fd, load_hashtables holds it while reading the tables
         if not fd:
             self.fd = open(filename, 'r')
         else:
             self.fd = fd
-        data = self.fd.read(4)
-        assert data in ("CON ", "PIRS", "LIVE"), "STFS Magic not found"
-
         self.table_spacing = [(0xAB, 0x718F, 0xFE7DA), #The distance in blocks between tables
                               (0xAC, 0x723A, 0xFD00B)] #For when tables are 1 block and when they are 2 blocks
-        self.magic = data
-        self.fd.seek(0)
-        self.data = self.fd.read(0x971A) # Header data (this is only a member during testing)
-        self.parse_header(self.data)
-        self.parse_filetable()
+        self.block_next = None # The block map, see load_hashtables
+        self.header_images_loaded = not lazy
+
+        self.data = self.fd.read(0x171A if lazy else 0x971A) # Header data (this is only a member during testing)
+        self.magic = self.data[:4]
+        assert self.magic in ("CON ", "PIRS", "LIVE"), "STFS Magic not found"
+        if lazy:
+            self.parse_fixed_header(self.data)
+        else:
+            self.parse_header(self.data)
+            self.parse_filetable()
+
+    def __getattr__(self, name):
+        """ Reads the parts of the container a lazy open skipped the first time they are used """
+        if name in ('allfiles', 'filelistings', 'paths', 'children', 'records', 'deleted_listings'):
+            self.parse_filetable()
+        elif name in STFS.LAZY_HEADER and not self.__dict__.get('header_images_loaded', True):
+            self.load_header_images()
+        else:
+            raise AttributeError("'STFS' object has no attribute '%s'" % name)
+        return object.__getattribute__(self, name)
+
+    def load_header_images(self):
+        """ Reads the whole header and parses the images and names after the fixed part of it """
+        with self.lock:
+            self.fd.seek(0)
+            data = self.fd.read(0x971A)
+        assert len(data) >= 0x971A, "STFS Data Too Short"
+        self.header_images_loaded = True
+        self.parse_header_images(data)
 
 
     def read_filetable(self, firstblock, numblocks):
         """ Given the length and start of the filetable return all its data
         """
-        buf = StringIO()
-        info = 0x80
-        block = firstblock
-        for i in xrange(0, numblocks):
-            buf.write(self.read_block(self.fix_blocknum(block), 0x1000))
-            blockhash = self.get_blockhash(block)
-            if self.table_size_shift > 0 and blockhash.info < 0x80:
-                blockhash = self.get_blockhash(block, 1)
-            block = blockhash.nextblock
-            info = blockhash.info
-        return buf.getvalue()
+        return self.read_blocks(self.get_chain(firstblock, numblocks, check=False), numblocks << 12)
     
     def parse_filetable(self):
         """ Generate objects for all the filelistings """
@@ -99,51 +246,243 @@ class STFS(object):
         #data = data.getvalue()
         data = self.read_filetable(self.filetable_blocknumber, self.filetable_blockcount)
 
+        self.records = {} # Index in the file table -> filelisting
+        self.deleted_listings = [] # Listings with their name cleared, see recover
         for x in range(0, len(data), 0x40): # File records are 0x40 length
             try:
-                self.filelistings.append(FileListing(data[x:x+0x40]))
+                fl = FileListing(data[x:x+0x40], x >> 6)
             except AssertionError:
-                pass
-        for fl in self.filelistings: # Build a dictionary to access filelistings by path
-            path_components = [fl.filename]
-            a = fl
-            while a.pathindex != -1 and a.pathindex < len(self.filelistings):
-                try:
-                    a = self.filelistings[a.pathindex]
-                    path_components.append(a.filename)
-                except IndexError:
-                    raise AssertionError("IndexError: %s %d %d" % (self.filename, a.pathindex, len(self.filelistings)))
-            path_components.append('')
-            path_components.reverse()
-            self.allfiles["/".join(path_components)] = fl
-                
+                if data[x:x+0x40].strip('\x00'): # Not an empty slot
+                    self.deleted_listings.append(FileListing(data[x:x+0x40], x >> 6, deleted=True))
+                continue
+            self.filelistings.append(fl)
+            self.records[fl.record] = fl
+        # Build a dictionary to access filelistings by path and an index of each directory's contents
+        self.paths = {} # File table index -> full path, filled in by get_path
+        self.children = {'': []} # Directory path ('' for the root) -> list of the filelistings in it
+        for fl in self.filelistings:
+            path = self.get_path(fl.record)
+            self.allfiles[path] = fl
+            self.children.setdefault(path[:-len(fl.filename) - 1], []).append(fl)
+            if fl.isdirectory:
+                self.children.setdefault(path, [])
+
+    def get_path(self, record):
+        """ Return the full path of the filelisting at record in the file table, following pathindex up
+            to the first ancestor whose path is already known and memoising the paths on the way back down
+        """
+        chain = []
+        while record != None and record not in self.paths:
+            chain.append(record)
+            if len(chain) > len(self.records):
+                raise AssertionError("Loop in file table: %s %d" % (self.filename, record))
+            pathindex = self.records[record].pathindex
+            record = pathindex if pathindex in self.records else None # -1 (or a missing listing) is the root
+
+        path = '' if record == None else self.paths[record]
+        for record in reversed(chain):
+            path = self.paths[record] = "%s/%s" % (path, self.records[record].filename)
+        return path
+
+    def listdir(self, path = '/'):
+        """ Return the names of the files in a directory (or None if there isn't one) """
+        children = self.children.get(path.rstrip('/'))
+        if children == None:
+            return None
+        return [fl.filename for fl in children]
+
+    def walk(self, path = '/'):
+        """ A generator that returns the path of every file and directory below path (breadth first) """
+        dirs = deque([path.rstrip('/')])
+        while len(dirs) > 0:
+            dirpath = dirs.popleft()
+            for fl in self.children.get(dirpath, ()):
+                fullpath = "%s/%s" % (dirpath, fl.filename)
+                if fl.isdirectory:
+                    dirs.append(fullpath)
+                yield fullpath
+
     def read_file(self, filelisting, size=-1):
         """ Given a filelisting object return its data
-            This requies checking each blockhash to find the next block.
-            In some cases this requires checking two different hash tables.
+            The chain of blocks comes from the block map (see load_hashtables).
         """
-        buf = StringIO()
         if size == -1:
             size = filelisting.size
+        return self.read_blocks(self.get_chain(filelisting.firstblock, (size + 0xFFF) >> 12), size)
+
+    def iter_file(self, filename=None, filelisting=None, chunksize=0x100000):
+        """ A generator that yields a file in chunks of about chunksize bytes (whole blocks) """
+        if not filelisting:
+            filelisting = self.allfiles[filename]
+        size = filelisting.size
+        blocks = self.get_chain(filelisting.firstblock, (size + 0xFFF) >> 12)
+        step = max(chunksize >> 12, 1)
+        for i in xrange(0, len(blocks), step):
+            yield self.read_blocks(blocks[i:i+step], min(step << 12, size))
+            size -= step << 12
+
+    def open_fd(self, path):
+        """ Return an STFSFD object for a file in the container (or None if there isn't one) """
+        fl = self.allfiles.get(path)
+        if fl == None or fl.isdirectory:
+            return None
+        return STFSFD(self, fl)
+
+    def read_blocks(self, blocks, size):
+        """ Reads size bytes from a list of data blocks.
+            Blocks that are physically in order with only hash tables between them are fetched with
+            a single read and the hash tables are sliced back out.
+        """
+        max_gap = 3 << self.table_size_shift # A level 0, level 1 and level 2 table can sit between blocks
+        physical = [self.fix_blocknum(block) for block in blocks]
+        bufs = []
+        i = 0
+        while i < len(physical) and size > 0:
+            j = i + 1
+            while j < len(physical) and 0 < physical[j] - physical[j-1] <= 1 + max_gap:
+                j += 1
+            first = physical[i]
+            span = self.read_block(first, physical[j-1] - first + 1 << 12)
+            if physical[j-1] - first == j - 1 - i: # No tables in the way
+                bufs.append(span[:size])
+                size -= min(j - i << 12, size)
+            else:
+                for block in physical[i:j]:
+                    readlen = min(0x1000, size)
+                    offset = block - first << 12
+                    bufs.append(span[offset:offset + readlen])
+                    size -= readlen
+            i = j
+        return "".join(bufs)
+
+    def load_hashtables(self):
+        """ Reads every level 0 hash table once into the block map.
+            block_next, block_info and block_table are arrays indexed by block number holding the
+            next block, the info byte and which table (0 or 1) the record came from.
+            block_hashes holds the 0x14 byte hashes of every block back to back.
+            When tables are two blocks long the record with the most current info is used, Current (0xC0)
+            beats Old (0x80) and allocated beats unallocated. Ties go to the first table.
+            The map is built under the lock and block_next is published last, so other threads either
+            see None and wait here or see the whole map.
+        """
+        with self.lock:
+            if self.block_next != None: # Another thread loaded it while this one waited
+                return
+            count = self.allocated_count
+            block_next = array.array('I')
+            block_info = array.array('B')
+            block_table = array.array('B')
+            hashes = []
+            for first in xrange(0, count, 0xAA):
+                records = min(0xAA, count - first)
+                data = self.read_block(self.hashtable_blocknum(first)).ljust(0x1000, '\x00')
+                values = HASH_TABLE.unpack_from(data)
+                if self.table_size_shift > 0:
+                    values = list(values)
+                    other = self.read_block(self.hashtable_blocknum(first, 1)).ljust(0x1000, '\x00')
+                    other_values = HASH_TABLE.unpack_from(other)
+                    for r in xrange(records):
+                        info = values[r] >> 24
+                        other_info = other_values[r] >> 24
+                        if info == 0xC0 or (info >= 0x80 and other_info != 0xC0):
+                            block_table.append(0)
+                            hashes.append(data[r * 0x18:r * 0x18 + 0x14])
+                        else:
+                            block_table.append(1)
+                            values[r] = other_values[r]
+                            hashes.append(other[r * 0x18:r * 0x18 + 0x14])
+                else:
+                    block_table.extend([0] * records)
+                    hashes.extend([data[r * 0x18:r * 0x18 + 0x14] for r in xrange(records)])
+                for value in values[:records]:
+                    block_info.append(value >> 24)
+                    block_next.append(value & 0xFFFFFF)
+            self.block_hashes = "".join(hashes)
+            self.block_table = block_table
+            self.block_info = block_info
+            self.block_next = block_next
+
+    def block_states(self):
+        """ Returns an array with the state of every allocated block, see BLOCK_STATE """
+        if self.block_next == None:
+            self.load_hashtables()
+        return array.array('B', self.block_info.tostring().translate(BLOCK_STATE))
+
+    def live_blocks(self):
+        """ Returns an array with a 1 for every block the file table or a file that hasn't been deleted uses """
+        live = array.array('B', [0]) * self.allocated_count
+        chains = [self.get_chain(self.filetable_blocknumber, self.filetable_blockcount, check=False)]
+        chains.extend(self.get_chain(fl.firstblock, fl.numblocks) for fl in self.filelistings if not fl.isdirectory)
+        for chain in chains:
+            for block in chain:
+                if 0 <= block < self.allocated_count:
+                    live[block] = 1
+        return live
+
+    def recover_chain(self, filelisting):
+        """ Works out the blocks of a deleted listing. Consecutive listings take the blocks after firstblock,
+            otherwise the next blocks left in the block map are followed whatever the blocks' state.
+        """
+        count = self.allocated_count
+        if filelisting.consecutive:
+            return range(filelisting.firstblock, min(filelisting.firstblock + filelisting.numblocks, count))
+        if self.block_next == None:
+            self.load_hashtables()
+        block_next = self.block_next
+        chain = []
+        seen = set()
         block = filelisting.firstblock
-        info = 0x80
-        while size > 0 and block > 0 and block < self.allocated_count and info >= 0x80:
-            readlen = min(0x1000, size)
-            buf.write(self.read_block(self.fix_blocknum(block), readlen))
-            size -= readlen
-            blockhash = self.get_blockhash(block) #TODO: Optional concurrent verification of blocks
-            #If there are multiple tables and the block is free or unused, try other table
-            #TODO: There may be times where both tables show allocated blocks yet only one was correct
-            #      It would be better to calculate the best chain of blocks, perhaps precalculate like Partition
-            if self.table_size_shift > 0 and blockhash.info < 0x80: 
-                blockhash = self.get_blockhash(block, 1)
-            block = blockhash.nextblock
-            info = blockhash.info
-        return buf.getvalue()
-    
-    def get_blockhash(self, blocknum, table_offset = 0):
-        """ Given a block number return the hash object that goes with it """
-        record = blocknum % 0xAA
+        while len(chain) < filelisting.numblocks and 0 <= block < len(block_next) and block not in seen:
+            chain.append(block)
+            seen.add(block)
+            block = block_next[block]
+        return chain
+
+    def recover(self):
+        """ Builds the block state map, reconstructs the chains of deleted listings and finds the blocks
+            that are in use but that nothing reaches. Returns a RecoveryReport.
+        """
+        begin = time.time()
+        states = self.block_states()
+        live = self.live_blocks()
+        report = RecoveryReport(states)
+        for fl in self.deleted_listings:
+            parent = self.get_path(fl.pathindex) if fl.pathindex in self.records else ''
+            blocks = self.recover_chain(fl)
+            overwritten = sum(live[block] for block in blocks)
+            report.deleted.append(DeletedFile(fl, "%s/%s" % (parent, fl.filename or "deleted-%d" % fl.record),\
+                                              blocks, overwritten))
+        report.orphans = [block for block in xrange(len(states)) if states[block] >= 2 and not live[block]]
+        report.seconds = time.time() - begin
+        return report
+
+    def read_deleted(self, deleted):
+        """ Returns the data of a DeletedFile (as much of it as its blocks cover) """
+        return self.read_blocks(deleted.blocks, min(deleted.listing.size, len(deleted.blocks) << 12))
+
+    def get_chain(self, block, count, check=True):
+        """ Follows the block map from block for up to count blocks and returns the blocks.
+            With check the chain stops at block 0, past allocated_count or after a block that isn't in use.
+        """
+        if self.block_next == None:
+            self.load_hashtables()
+        block_next = self.block_next
+        block_info = self.block_info
+        mapped = len(block_next)
+        chain = []
+        while len(chain) < count:
+            if check and (block <= 0 or block >= self.allocated_count):
+                break
+            chain.append(block)
+            if block >= mapped:
+                break
+            if check and block_info[block] < 0x80:
+                break
+            block = block_next[block]
+        return chain
+
+    def hashtable_blocknum(self, blocknum, table_offset = 0):
+        """ Given a block number return the number of the hash table block that has its record """
         #Num tables * space blocks between each (0xAB or 0xAC for [0])
         tablenum = blocknum // 0xAA * self.table_spacing[self.table_size_shift][0]
         if blocknum >= 0xAA:
@@ -151,14 +490,105 @@ class STFS(object):
             if blocknum >= 0x70E4:
                 tablenum += 1 << self.table_size_shift #If we're into level 2 add the level 2 table
 
-        # Read the table block, get the correct record and pass it to BlockHashRecord
-        
         # Fix to point at the first table (these numbers are offset from data block numbers)
-        tablenum += table_offset - (1 << self.table_size_shift) 
+        return tablenum + table_offset - (1 << self.table_size_shift) 
+
+    def level1_blocknum(self, blocknum):
+        """ Given a block number return the number of the level 1 hash table block that covers it """
+        if blocknum < 0x70E4:
+            return self.table_spacing[self.table_size_shift][0] - (1 << self.table_size_shift)
+        return blocknum // 0x70E4 * self.table_spacing[self.table_size_shift][1]
+
+    def level2_blocknum(self):
+        """ Return the number of the level 2 hash table block, only containers over 0x70E4 blocks have one """
+        return self.table_spacing[self.table_size_shift][1] - (1 << self.table_size_shift)
+    
+    def get_blockhash(self, blocknum, table_offset = 0):
+        """ Given a block number return the hash object that goes with it """
+        record = blocknum % 0xAA
+        # Read the table block, get the correct record and pass it to BlockHashRecord
+        tablenum = self.hashtable_blocknum(blocknum, table_offset)
         hashdata = self.read_block(tablenum)
         return BlockHashRecord(blocknum, hashdata[record * 0x18: record * 0x18 + 0x18],\
                                table = tablenum, record = record)
 
+    def verify(self, workers=4, batch=0x100):
+        """ Verifies the whole hash tree from the top down and returns a VerifyReport.
+            The top table (level 0, 1 or 2 depending on the size) is checked against tophashtable_hash,
+            each table against its record in the table above and every block in use against its level 0
+            record. Blocks are hashed in batches by a pool of workers threads (hashlib releases the GIL
+            while hashing). With two block tables a table passes if either copy matches.
+        """
+        begin = time.time()
+        if self.block_next == None:
+            self.load_hashtables()
+        count = self.allocated_count
+        report = VerifyReport(count)
+
+        level0 = [self.hashtable_blocknum(first) for first in xrange(0, count, 0xAA)]
+        if count <= 0xAA and len(level0) > 0:
+            report.top = self.verify_table(level0[0], self.tophashtable_hash, report) != None
+        elif count <= 0x70E4:
+            report.top = self.verify_tables(self.level1_blocknum(0), self.tophashtable_hash, level0, report)
+        else:
+            level1 = [self.level1_blocknum(first) for first in xrange(0, count, 0x70E4)]
+            records = self.verify_table(self.level2_blocknum(), self.tophashtable_hash, report)
+            report.top = records != None
+            if records == None:
+                records = self.read_block(self.level2_blocknum())
+            for k, table in enumerate(level1):
+                self.verify_tables(table, records[k * 0x18:k * 0x18 + 0x14], level0[k * 0xAA:k * 0xAA + 0xAA], report)
+
+        pool = ThreadPool(workers)
+        try:
+            batches = [(first, min(first + batch, count)) for first in xrange(0, count, batch)]
+            for first, results in pool.imap_unordered(self.verify_blocks, batches):
+                report.blocks[first:first + len(results)] = results
+        finally:
+            pool.close()
+            pool.join()
+        report.bytes = report.blocks.count(1) + report.blocks.count(0) << 12
+        report.seconds = time.time() - begin
+        return report
+
+    def verify_table(self, tablenum, expected, report):
+        """ Checks a hash table block (either copy) against its expected hash.
+            Records the result in report and returns the matching table data or None.
+        """
+        for copy in xrange(1 << self.table_size_shift):
+            data = self.read_block(tablenum + copy)
+            if hashlib.sha1(data).digest() == expected:
+                report.tables[tablenum] = True
+                return data
+        report.tables[tablenum] = False
+        return None
+
+    def verify_tables(self, tablenum, expected, children, report):
+        """ Checks a hash table against its expected hash and the tables in children against its records.
+            Returns whether the table itself matched.
+        """
+        records = self.verify_table(tablenum, expected, report)
+        if records == None: # Still check the children against the first copy so the report says which failed
+            records = self.read_block(tablenum)
+        for k, table in enumerate(children):
+            self.verify_table(table, records[k * 0x18:k * 0x18 + 0x14], report)
+        return report.tables[tablenum]
+
+    def verify_blocks(self, blocks):
+        """ Checks the blocks first to end (a tuple) against the block map, returns (first, results) """
+        first, end = blocks
+        start = self.fix_blocknum(first)
+        span = self.read_block(start, self.fix_blocknum(end - 1) - start + 1 << 12)
+        results = array.array('b')
+        for block in xrange(first, end):
+            if self.block_info[block] < 0x80: # Not in use so there's nothing to check
+                results.append(-1)
+                continue
+            offset = self.fix_blocknum(block) - start << 12
+            digest = hashlib.sha1(span[offset:offset + 0x1000]).digest()
+            results.append(int(digest == self.block_hashes[block * 0x14:block * 0x14 + 0x14]))
+        return first, results
+
     def verify_block(self, blockhash):
         """ Check the data in the block versus its recorded hash """
         data = self.read_block(self.fix_blocknum(blockhash.blocknum))
@@ -180,7 +610,7 @@ class STFS(object):
 
         if block_num >= 0xAA:
             block_adjust += ((block_num // 0xAA)) + 1 << self.table_size_shift
-        if block_num > 0x70E4:
+        if block_num >= 0x70E4:
             block_adjust += ((block_num // 0x70E4) + 1)<< self.table_size_shift
         return block_adjust + block_num
     
@@ -189,14 +619,21 @@ class STFS(object):
             Read a block given its block number
             If reading data blocks call fix_blocknum first
         """
-        self.fd.seek(0xc000 + blocknum * 0x1000)
-        return self.fd.read(length)
+        with self.lock:
+            self.fd.seek(0xc000 + blocknum * 0x1000)
+            return self.fd.read(length)
 
     # This is a huge, messy struct parsing function.
     # There is almost no logic here, just offsets.
     def parse_header(self, data):
         """ Parse the huge STFS header """
         assert len(data) >= 0x971A, "STFS Data Too Short"
+        self.parse_fixed_header(data)
+        self.parse_header_images(data)
+
+    def parse_fixed_header(self, data):
+        """ Parse the header up to the thumbnail, everything but the images and additional names """
+        assert len(data) >= 0x171A, "STFS Data Too Short"
         self.magic = data[0:4]
         if self.magic == "CON ":
             self.console_id = data[6:11]
@@ -229,7 +666,7 @@ class STFS(object):
             pass
         else:
             self.console_id = data[0x36C:0x36C+5]
-        self.profile_id = data[0x371:0x376]
+        self.profile_id = data[0x371:0x379]
         
         self.volume_descriptor_size = ord(data[0x379:0x37A])
         self.block_seperation = ord(data[0x37B])
@@ -253,16 +690,12 @@ class STFS(object):
         self.transfer_flags = data[0x1711:0x1712]
         self.thumbnail_size = struct.unpack(">I", data[0x1712:0x1712+4])[0]
         self.titleimage_size = struct.unpack(">I", data[0x1716:0x1716+4])[0]
-        self.thumbnail = data[0x171A:0x171A+self.thumbnail_size]
-        self.titleimage = data[0x571A:0x571A+self.titleimage_size]
         
         if self.metadata_version == 2:
             self.series_id = data[0x3B1:0x3B1+0x10]
             self.season_id = data[0x3C1:0x3C1+0x10]
             self.season_number = struct.unpack(">H", data[0x3D1:0x3D1+2])[0]
             self.episode_number = struct.unpack(">H", data[0x3D3:0x3D3+2])[0]
-            self.additional_display_names = data[0x541A:0x541A+0x300]
-            self.additional_display_descriptions = data[0x941A:0x941A+0x300] 
         
         # Are the hash tables 1 or 2 blocks long?
         if ((self.entry_id + 0xFFF) & 0xF000) >> 0xC == 0xB:
@@ -270,33 +703,26 @@ class STFS(object):
         else:
             self.table_size_shift = 1
 
+    def parse_header_images(self, data):
+        """ Parse the thumbnail, title image and additional names from the rest of the header """
+        self.thumbnail = data[0x171A:0x171A+self.thumbnail_size]
+        self.titleimage = data[0x571A:0x571A+self.titleimage_size]
+        if self.metadata_version == 2:
+            self.additional_display_names = data[0x541A:0x541A+0x300]
+            self.additional_display_descriptions = data[0x941A:0x941A+0x300] 
 
-def extract_all(argv):
+
+def extract_all(argv, workers=4):
     if len(argv) < 3:
         print "Usage: stfs.py <input file> <output directory>"
         print "Dumps contents of stfs file to disk"
         return
-    s = STFS(argv[1])
-    for filename in s.allfiles: # Loop once creating all the directories
-        if s.allfiles[filename].isdirectory:
-            print "Creating directory %s" % filename
-            dirpath = filename[1:]
-            dircomponents = dirpath.split('/')
-            for i in xrange(len(dircomponents)):
-                try:
-                    os.mkdir("%s/%s" % (argv[2], "/".join(dircomponents[:i+1])))
-                except OSError:
-                    pass
-    for filename in s.allfiles: # Loop again writing all the files
-        if not s.allfiles[filename].isdirectory:
-            print "Writing file %s" % filename
-            try:
-                open("%s/%s" % (argv[2], filename), 'w').write(s.read_file(s.allfiles[filename]))
-            except Exception as e:
-                print e
-                print argv[2], filename
+    from extract import Extractor
+    report = Extractor(STFS(argv[1]), argv[2], workers=workers).run()
+    for filename, error in report.errors:
+        print "Error writing %s: %s" % (filename, error)
+    print report
 
 if __name__ == '__main__':
     import sys
-    import os
     extract_all(sys.argv)
@@ -4,8 +4,8 @@
     Returns a string denoting file type
 """
 
-from py360 import *
 PNG_HEADER = "\x89PNG\x0D\x0A\x1A\x0A"
+PNG_FOOTER = "\x00\x00\x00\x00IEND\xAE\x42\x60\x82" # An empty IEND chunk and its CRC
 XTAF_HEADER = "XTAF"
 XDBF_HEADER = "XDBF"
 STFS_HEADERS = ("CON ", "PIRS", "LIVE")
@@ -5,11 +5,45 @@ TODO: Handle Sync Lists
 TODO: Sort out unicode problems
 """
 
+import re
 import struct
 import xboxtime
 import time
 from constants import GPDID, GamerTagConstants
 
+# Precompiled decoders for each byte order (XDBF files are big endian, FBDX little endian)
+HEADER = dict((bo, struct.Struct(bo + "4sIIIII")) for bo in '<>')
+ENTRY = dict((bo, struct.Struct(bo + "HQII")) for bo in '<>') # namespace, id, offset, length
+FREE = dict((bo, struct.Struct(bo + "II")) for bo in '<>') # offset, length
+UINT = dict((bo, struct.Struct(bo + "I")) for bo in '<>')
+ACHIEVEMENT = dict((bo, struct.Struct(bo + "IIIIIq")) for bo in '<>') # magic, id, image id, gamerscore, flags, time
+TITLE = dict((bo, struct.Struct(bo + "Iiiiiqiq")) for bo in '<>')
+# Setting values start at 0x10, strings and binary values start with their length
+SETTING_VALUE = dict((bo, dict((content_id, struct.Struct(bo + fmt)) for content_id, fmt in\
+                      ((0, "I"), (1, "I"), (2, "Q"), (3, "d"), (4, "I"), (5, "f"), (6, "I"), (7, "Q")))) for bo in '<>')
+
+# Signatures carve looks for in free space: the achievement magic, known setting ids (their top nibble is
+# the content id) and the top two bytes of a title's last played FILETIME (0x01C0-0x01DF is 2000 to 2029)
+CARVE_ACHIEVEMENT = dict((bo, re.compile(re.escape(UINT[bo].pack(28)))) for bo in '<>')
+CARVE_SETTING = dict((bo, re.compile("|".join(re.escape(UINT[bo].pack(setting_id)) for setting_id in sorted(GPDID.types)\
+                      if 0 < setting_id >> 28 < 8 and setting_id & 0xFFFFFFF))) for bo in '<>')
+CARVE_TITLE = {'>': (re.compile("\x01[\xc0-\xdf]"), 32), '<': (re.compile("[\xc0-\xdf]\x01"), 38)} # And the title start
+
+def string_end(data, start):
+    """ Returns where the null terminated utf-16 string at start ends.
+        A missing terminator gives start - 1 so the string slices to empty, as data[start:].find did.
+    """
+    end = data.find('\x00\x00', start)
+    if end == -1:
+        return start - 1
+    return end
+
+def utf16(raw):
+    """ Convert utf-16-be data in a raw string to a unicode object """
+    if raw:
+        return unicode(raw, 'utf-16-be')
+    return u''
+
 class Setting(object):
     """ Represents a Setting entry
         Some values can be resolved by matching them against constant objects
@@ -39,36 +73,22 @@ class Setting(object):
 
     def __init__(self, data, byte_order = '>'):
         self.content_id = ord(data[8])
-        self.setting_id = struct.unpack(byte_order + 'I', data[0:4])[0]
-
-        if self.content_id == 0: # Context
-            self.data = struct.unpack(byte_order + "I", data[16:20])[0]
+        self.setting_id = UINT[byte_order].unpack_from(data)[0]
+        decoder = SETTING_VALUE[byte_order].get(self.content_id)
 
-        elif self.content_id == 1: #Unsigned Integer
-            self.data = struct.unpack(byte_order + "I", data[16:20])[0]
-
-        elif self.content_id == 2: #Long long
-            self.data = struct.unpack(byte_order + "Q", data[16:24])[0]
-        
-        elif self.content_id == 3: #Double
-            self.data = struct.unpack(byte_order + "d", data[16:24])[0]
-
-        elif self.content_id == 4: #UTF16-BE
-            length = struct.unpack(byte_order + "I", data[16:20])[0]
-            self.data = unicode(data[24:24+length], 'utf-16-be')
+        if decoder == None: #Null
+            self.data = data[9:17]
+            return
+        value = decoder.unpack(data[16:16 + decoder.size])[0]
 
-        elif self.content_id == 5: #Float
-            self.data = struct.unpack(byte_order + "f", data[16:20])[0]
+        if self.content_id == 4: #UTF16-BE
+            self.data = unicode(data[24:24+value], 'utf-16-be')
 
         elif self.content_id == 6: #Binary
-            length = struct.unpack(byte_order + "I", data[16:20])[0]
-            self.data = data[24:24+length]
-
-        elif self.content_id == 7: #Timestamp
-            self.data = struct.unpack(byte_order + "Q", data[16:24])[0]
+            self.data = data[24:24+value]
 
-        else: #Null
-            self.data = data[9:17]
+        else: # Context, unsigned integer, long long, double, float and timestamp
+            self.data = value
 
 class Title(object):
     """ Represents a title entry
@@ -81,24 +101,17 @@ class Title(object):
         return " ".join(result)
         
     def __init__(self, data, byte_order = '>'):
-        self.title_id = struct.unpack(byte_order + 'I', data[0:4])[0]
-        self.achievement_count = struct.unpack(byte_order + 'i', data[4:8])[0]
-        self.achievement_unlocked = struct.unpack(byte_order + 'i', data[8:12])[0]
-        self.gamerscore_total = struct.unpack(byte_order + 'i', data[12:16])[0]
-        self.gamerscore_unlocked = struct.unpack(byte_order + 'i', data[16:20])[0]
-        self.unknown1 = struct.unpack(byte_order + 'q', data[20:28])[0]
-        self.unknown2 = struct.unpack(byte_order + 'i', data[28:32])[0]
-        self.last_played = struct.unpack(byte_order + 'q', data[32:40])[0]
-        end_name = 40 + data[40:].find('\x00\x00')
-        self.name = data[40:end_name]
+        self.title_id, self.achievement_count, self.achievement_unlocked, self.gamerscore_total,\
+        self.gamerscore_unlocked, self.unknown1, self.unknown2, self.last_played = TITLE[byte_order].unpack_from(data)
+        self.name = data[40:string_end(data, 40)]
 
     # Due to intermittent unicode problems I decided to store the data raw and convert it only when needed
+    name_text = None # The converted strings are kept once get_name has been called
     def get_name(self):
         """ Convert the name from utf-16-be data in a raw string to a unicode object """
-        if self.name:
-            return unicode(self.name, 'utf-16-be')
-        else:
-            return u''
+        if self.name_text == None:
+            self.name_text = utf16(self.name)
+        return self.name_text
 
 class Achievement(object):
     """ Achievement entry object
@@ -112,50 +125,56 @@ class Achievement(object):
         return " ".join(result)
 
     def __init__(self, data, byte_order = '>'):
-        self.achievement_id = None
-        self.image_id = None
-        self.gamer_score = None
-        self.flags = None
-        self.unlock_time = None
-        self.name = None
-        self.locked_desc = None
-        self.unlocked_desc = None
-        self.magic = struct.unpack(byte_order + 'I', data[0:4])[0]
-        if self.magic != 28 or len(data) < 28:
-            return
-        self.achievement_id = struct.unpack(byte_order + 'I', data[4:8])[0]
-        self.image_id = struct.unpack(byte_order + 'I', data[8:12])[0]
-        self.gamer_score = struct.unpack(byte_order + 'I', data[12:16])[0]
-        self.flags = struct.unpack(byte_order + 'I', data[16:20])[0]
-        self.unlock_time = xboxtime.filetime2unixtime(struct.unpack(byte_order + 'q', data[20:28])[0])
-
-        end_name = 28 + data[28:].find('\x00\x00')
-        self.name = data[28:end_name]
-        end_locked_desc = end_name + 2 + data[end_name+2:].find('\x00\x00') #+2 to skip previous null
-        self.locked_desc = data[end_name+2:end_locked_desc]
-        end_unlocked_desc = end_locked_desc + 2 + data[end_locked_desc+2:].find('\x00\x00')
-        self.unlocked_desc = data[end_locked_desc+2:end_unlocked_desc]
+        """ Only the fixed fields are decoded here, the unlock time and strings wait until used (see __getattr__) """
+        if len(data) >= 28:
+            self.magic, self.achievement_id, self.image_id, self.gamer_score, self.flags, self.filetime =\
+                ACHIEVEMENT[byte_order].unpack_from(data)
+            if self.magic == 28:
+                self.raw = data # For the strings
+                return
+        self.magic = UINT[byte_order].unpack_from(data)[0]
+        self.achievement_id = self.image_id = self.gamer_score = self.flags = self.unlock_time = None
+        self.name = self.locked_desc = self.unlocked_desc = None
+
+    def __getattr__(self, name):
+        if name == 'unlock_time':
+            self.unlock_time = xboxtime.filetime2unixtime(self.filetime)
+            return self.unlock_time
+        if name not in ('name', 'locked_desc', 'unlocked_desc'):
+            raise AttributeError(name)
+        data = self.raw
+        strings = data[28:].split('\x00\x00', 3) # One pass when all three strings are terminated
+        if len(strings) == 4:
+            self.name, self.locked_desc, self.unlocked_desc = strings[:3]
+        else:
+            end_name = string_end(data, 28)
+            self.name = data[28:end_name]
+            end_locked_desc = string_end(data, end_name + 2) #+2 to skip previous null
+            self.locked_desc = data[end_name+2:end_locked_desc]
+            end_unlocked_desc = string_end(data, end_locked_desc + 2)
+            self.unlocked_desc = data[end_locked_desc+2:end_unlocked_desc]
+        return getattr(self, name)
+
+    # The converted strings are kept once the get methods have been called
+    name_text = locked_desc_text = unlocked_desc_text = None
 
     def get_name(self):
         """ Convert the name from utf-16-be data in a raw string to a unicode object """
-        if self.name:
-            return unicode(self.name, 'utf-16-be')
-        else:
-            return u''
+        if self.name_text == None:
+            self.name_text = utf16(self.name)
+        return self.name_text
 
     def get_locked_desc(self):
         """ Convert the locked description from utf-16-be data in a raw string to a unicode object """
-        if self.locked_desc:
-            return unicode(self.locked_desc, 'utf-16-be')
-        else:
-            return u''
+        if self.locked_desc_text == None:
+            self.locked_desc_text = utf16(self.locked_desc)
+        return self.locked_desc_text
 
     def get_unlocked_desc(self):
         """ Convert the unlocked description from utf-16-be data in a raw string to a unicode object """
-        if self.unlocked_desc:
-            return unicode(self.unlocked_desc, 'utf-16-be')
-        else:
-            return u''
+        if self.unlocked_desc_text == None:
+            self.unlocked_desc_text = utf16(self.unlocked_desc)
+        return self.unlocked_desc_text
 
 class Entry(object):
     """ Entry object which describes where to find the data inside the file and its payload type 
@@ -166,38 +185,59 @@ class Entry(object):
     def __str__(self):
         return "GPD Entry: %s %s" % (hex(self.idnum), Entry.namespaces[self.namespace]) 
 
-    def __init__(self, data, global_offset, fd, byte_order = '>'):
-        self.namespace = struct.unpack(byte_order + 'H', data[0:2])[0]
-        self.idnum = struct.unpack(byte_order + 'Q', data[2:10])[0]
-        self.offset = struct.unpack(byte_order + 'I', data[10:14])[0]
-        self.length = struct.unpack(byte_order + 'I', data[14:18])[0]
-        self.payload = None
-
-
+    def __init__(self, namespace, idnum, offset, length, data, start, byte_order = '>'):
+        """ Takes the decoded entry table fields, the file's data and where the payload starts in it.
+            The payload is decoded the first time it is used, see __getattr__.
+        """
+        self.namespace = namespace
+        self.idnum = idnum
+        self.offset = offset
+        self.length = length
+        self.data = data
+        self.start = start
+        self.byte_order = byte_order
+
+    def __getattr__(self, name):
+        if name != 'payload':
+            raise AttributeError("'Entry' object has no attribute '%s'" % name)
+        self.payload = self.decode()
+        return self.payload
+
+    def decode(self):
+        """ Returns the payload object (or None if there isn't a usable one). Images are buffers into the file's data. """
         if self.namespace not in Entry.namespaces or\
         self.length <= 0:
-            return
+            return None
 
-        # TODO: Get paydata
-        fd.seek(self.offset + global_offset)
-        paydata = fd.read(self.length) 
-        if Entry.namespaces[self.namespace] == 'Achievement':
+        ns = Entry.namespaces[self.namespace]
+        if ns == 'Image':
+            return buffer(self.data, self.start, self.length)
+        paydata = self.data[self.start:self.start + self.length]
+        if ns == 'Achievement':
             if len(paydata) > 28:
-                self.payload = Achievement(paydata, byte_order)
-            else:
-                return
-        elif Entry.namespaces[self.namespace] == 'Title': 
+                return Achievement(paydata, self.byte_order)
+        elif ns == 'Title': 
             if len(paydata) > 40:
-                self.payload = Title(paydata, byte_order)
-            else:
-                return
-        elif Entry.namespaces[self.namespace] == 'Setting':
+                return Title(paydata, self.byte_order)
+        elif ns == 'Setting':
             if len(paydata) > 20:
-                self.payload = Setting(paydata, byte_order)
-            else:
-                return
+                return Setting(paydata, self.byte_order)
         else:
-            self.payload = paydata
+            return paydata
+        return None
+
+class CarvedEntry(object):
+    """ A payload found in the free space of an XDBF file, see XDBF.carve
+        offset is from the start of the data area like Entry.offset and length is how much the payload used
+    """
+    def __str__(self):
+        return "GPD Carved %s at 0x%x: %s" % (Entry.namespaces[self.namespace], self.offset, self.payload)
+
+    def __init__(self, namespace, offset, length, payload):
+        self.namespace = namespace
+        self.offset = offset
+        self.length = length
+        self.payload = payload
 
 class XDBF(object):
     """ 
@@ -205,6 +245,7 @@ class XDBF(object):
         Contains dictionaries that map id numbers to entries
         achievements, images, strings, titles, settings
         These can also be accessed via the list of Entry objects and their payload member
+        Only the entry table is decoded when the file is opened, the dictionaries are built when first used
     """
     def __str__(self):
         return "XDBF (%s - %d)" % (self.filename, len(self.entries))
@@ -215,7 +256,7 @@ class XDBF(object):
             self.fd = open(filename)
         else:
             self.fd = fd
-        data = self.fd.read(0x18)
+        data = self.fd.read() # The whole file, entries are decoded and payloads sliced from this
         
         if data[:4] == "\x58\x44\x42\x46": #XDBF
             self.byte_order = '>'
@@ -224,43 +265,118 @@ class XDBF(object):
         else:
             raise AssertionError("XDBF Magic Not Found")
 
-        self.version = struct.unpack(self.byte_order + 'I', data[4:8])[0]
-        self.table_len = struct.unpack(self.byte_order + 'I', data[8:12])[0]
-        self.entry_count = struct.unpack(self.byte_order + 'I', data[12:16])[0]
-        self.free_len = struct.unpack(self.byte_order + 'I', data[16:20])[0]
-        self.free_count = struct.unpack(self.byte_order + 'I', data[20:24])[0]
+        magic, self.version, self.table_len, self.entry_count, self.free_len, self.free_count =\
+            HEADER[self.byte_order].unpack_from(data)
         self.global_offset = self.table_len * 0x12 + self.free_len * 0x8 + 0x18
 
 
+        self.data = data
         self.entries = []
-        self.achievements = {}
-        self.images = {}
-        self.settings = {}
-        self.titles = {}
-        self.strings = {}
-        self.process_entries()
+        self.process_entries(data)
+        self.process_free(data)
         self.fd.close()
 
-    def process_entries(self):
-        """ Populates the entries list and the various payload dictionaries """
+    # The payload dictionaries and the namespace whose payloads they hold
+    payload_dicts = {'achievements': 'Achievement', 'images': 'Image', 'settings': 'Setting',\
+                     'titles': 'Title', 'strings': 'String'}
+
+    def __getattr__(self, name):
+        """ Builds a payload dictionary, decoding its entries' payloads, the first time it is used """
+        if name not in XDBF.payload_dicts:
+            raise AttributeError("'XDBF' object has no attribute '%s'" % name)
+        payloads = {}
+        for e in self.entries:
+            if Entry.namespaces.get(e.namespace) == XDBF.payload_dicts[name] and e.payload:
+                payloads[e.idnum] = e.payload
+        setattr(self, name, payloads)
+        return payloads
+
+    def process_entries(self, data):
+        """ Populates the entries list from the entry table, payloads are left until they are used """
+        decode = ENTRY[self.byte_order].unpack_from
+        global_offset = self.global_offset
         for c in xrange(0, self.entry_count):
-            self.fd.seek(0x18 + 0x12 * c, 0) 
-            data = self.fd.read(0x12)
-            e = Entry(data, self.global_offset, self.fd, self.byte_order)
-            self.entries.append(e)
-
-            if e.payload: 
-                ns = Entry.namespaces[e.namespace]
-                if ns == 'Achievement':
-                    self.achievements[e.idnum] = e.payload
-                elif ns == 'Title':
-                    self.titles[e.idnum] = e.payload
-                elif ns == 'Setting':
-                    self.settings[e.idnum] = e.payload
-                elif ns == 'Image':
-                    self.images[e.idnum] = e.payload
-                elif ns == 'String':
-                    self.strings[e.idnum] = e.payload
+            namespace, idnum, offset, length = decode(data, 0x18 + 0x12 * c)
+            self.entries.append(Entry(namespace, idnum, offset, length, data, offset + global_offset, self.byte_order))
+
+    def process_free(self, data):
+        """ Populates the free list with the (offset, length) of each free space table entry """
+        decode = FREE[self.byte_order].unpack_from
+        start = 0x18 + self.table_len * 0x12
+        self.free = [decode(data, start + 8 * c) for c in xrange(0, min(self.free_count, self.free_len))]
+
+    def free_regions(self):
+        """ Returns the (start, end) in the file of each region in the free space table """
+        size = len(self.data)
+        return [(min(self.global_offset + offset, size), min(self.global_offset + offset + length, size))\
+                for offset, length in self.free]
+
+    def carve(self, regions=None):
+        """ Looks for achievement, setting and title payloads in regions, a list of (start, end) in the file
+            (the free space table by default). Candidates are found with regular expressions over the file's
+            data and only those that decode sensibly are kept. Returns a list of CarvedEntry by offset.
+        """
+        if regions == None:
+            regions = self.free_regions()
+        data = self.data
+        found = []
+        for start, end in regions:
+            for match in CARVE_ACHIEVEMENT[self.byte_order].finditer(data, start, end):
+                found.append(self.carve_achievement(match.start(), end))
+            for match in CARVE_SETTING[self.byte_order].finditer(data, start, end):
+                found.append(self.carve_setting(match.start(), end))
+            pattern, title_offset = CARVE_TITLE[self.byte_order]
+            for match in pattern.finditer(data, start + title_offset, end):
+                found.append(self.carve_title(match.start() - title_offset, end))
+
+        carved = []
+        covered = 0 # Matches inside a payload that has already been carved are dropped
+        for carved_entry in sorted((c for c in found if c != None), key=lambda c: c.offset):
+            if carved_entry.offset + self.global_offset >= covered:
+                carved.append(carved_entry)
+                covered = carved_entry.offset + self.global_offset + carved_entry.length
+        return carved
+
+    def carve_achievement(self, start, end):
+        """ Returns a CarvedEntry for an achievement at start or None if it doesn't look like one """
+        a = Achievement(self.data[start:end], self.byte_order)
+        if a.achievement_id == None or not a.name or len(a.name) & 1 or len(a.locked_desc) & 1 or len(a.unlocked_desc) & 1:
+            return None
+        try:
+            a.get_name(), a.get_locked_desc(), a.get_unlocked_desc()
+        except UnicodeDecodeError:
+            return None
+        length = min(28 + len(a.name) + len(a.locked_desc) + len(a.unlocked_desc) + 6, end - start)
+        return CarvedEntry(1, start - self.global_offset, length, a)
+
+    def carve_setting(self, start, end):
+        """ Returns a CarvedEntry for a setting at start or None if it doesn't look like one """
+        if end - start < 0x18:
+            return None
+        try:
+            s = Setting(self.data[start:end], self.byte_order)
+        except (struct.error, UnicodeDecodeError):
+            return None
+        if s.content_id != s.setting_id >> 28:
+            return None
+        length = 0x18
+        if s.content_id in (4, 6): # Strings and binary values follow the fixed part
+            length += len(s.data) * (2 if s.content_id == 4 else 1)
+        return CarvedEntry(3, start - self.global_offset, min(length, end - start), s)
+
+    def carve_title(self, start, end):
+        """ Returns a CarvedEntry for a title at start or None if it doesn't look like one """
+        if end - start <= 40:
+            return None
+        t = Title(self.data[start:end], self.byte_order)
+        if not (0 <= t.achievement_unlocked <= t.achievement_count <= 0x400 and\
+                0 <= t.gamerscore_unlocked <= t.gamerscore_total <= 100000) or not t.name or len(t.name) & 1:
+            return None
+        try:
+            t.get_name()
+        except UnicodeDecodeError:
+            return None
+        return CarvedEntry(4, start - self.global_offset, min(40 + len(t.name) + 2, end - start), t)
 
 def print_xdbf(argv):
     if len(argv) < 2:
@@ -7,7 +7,6 @@ This version allows function reuse and swaps prints with a call to Report360.out
 
 import time, os, sys
 from py360 import xdbf, partition, account, stfs, xboxmagic, xboxtime
-from cStringIO import StringIO
 
 class Report360:
     """ A class to output information about py360 types """
@@ -51,13 +50,9 @@ class Report360:
         self.output("*********************")
         self.output("\nFILE LISTING")
         #for filename in part.allfiles:
-        for filename in part.walk():
-            fi = part.get_file(filename)
-            if fi.fr:
-                self.output("File: %s\t%d" % (filename, fi.fr.fsize))
-                self.output("%s\t%s\t%s\n" % (time.ctime(xboxtime.fat2unixtime(fi.fr.mtime, fi.fr.mdate)),\
-                                            time.ctime(xboxtime.fat2unixtime(fi.fr.atime, fi.fr.adate)),\
-                                            time.ctime(xboxtime.fat2unixtime(fi.fr.ctime, fi.fr.cdate))))
+        for entry in part.scan(deleted = True):
+            self.output("File: %s\t%d" % (entry.path, entry.size))
+            self.output("%s\t%s\t%s\n" % (time.ctime(entry.mtime), time.ctime(entry.atime), time.ctime(entry.ctime)))
                                             
     def print_stfs(self, stf):
         """ Prints out information contained in the provided STFS object """
@@ -177,8 +172,7 @@ class Report360:
                             # Process GPD files
                             if magic == 'XDBF':
                                 self.output("Processing GPD File %s" % stfsfile, self.errfd)
-                                # Maybe STFS needs an equivalent to Partition.open_fd(filename)
-                                g = xdbf.XDBF(stfsfile, fd=StringIO(s.read_file(s.allfiles[stfsfile])))
+                                g = xdbf.XDBF(stfsfile, fd=s.open_fd(stfsfile))
                                 self.print_xdbf(g)
                                 if self.image_directory != None: # Extract all the images
                                     for gpdimage in g.images: